@@ -5,19 +5,44 @@ Checks if model file is valid and compatible with ONNX Runtime
 """
 import os
 import sys
+import traceback
 
-def check_model_with_onnx():
-    """Check model using ONNX library"""
+# Full tracebacks only when debugging (same DEBUG variable as the backend .env)
+DEBUG = os.environ.get('DEBUG', '').lower() in ('1', 'true', 'yes')
+
+# ONNX Runtime sessions by model path - graph parsing/optimization runs once
+_sessions = {}
+
+def get_session(model_path, model_bytes):
+    """Return a cached ONNX Runtime session for model_path, created from model_bytes"""
+    session = _sessions.get(model_path)
+    if session is None:
+        import onnxruntime as ort
+        from config import onnx_thread_count
+        
+        sess_options = ort.SessionOptions()
+        sess_options.intra_op_num_threads = onnx_thread_count()
+        sess_options.inter_op_num_threads = 1
+        sess_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        sess_options.enable_mem_pattern = True
+        sess_options.enable_cpu_mem_arena = True
+        
+        session = ort.InferenceSession(
+            model_bytes,
+            sess_options=sess_options,
+            providers=['CPUExecutionProvider']
+        )
+        _sessions[model_path] = session
+    return session
+
+def check_model_with_onnx(model_bytes):
+    """Check model using ONNX library (parses the already-read model bytes)"""
     try:
         import onnx
-        model_path = 'models/face_embedding.onnx'
-        
-        if not os.path.exists(model_path):
-            print(f"✗ Model file not found: {model_path}")
-            return False
         
         print(f"Loading model with ONNX library...")
-        model = onnx.load(model_path)
+        model = onnx.load_from_string(model_bytes)
         
         print("✓ Model loaded successfully")
         print(f"  IR version: {model.ir_version}")
@@ -42,33 +67,20 @@ def check_model_with_onnx():
         return False
     except Exception as e:
         print(f"✗ Model validation failed: {e}")
-        import traceback
-        traceback.print_exc()
+        if DEBUG:
+            traceback.print_exc()
         return False
 
-def check_model_with_onnxruntime():
-    """Check model using ONNX Runtime"""
+def check_model_with_onnxruntime(model_path, model_bytes):
+    """Check model using ONNX Runtime (cached session built from the already-read model bytes)"""
     try:
         import onnxruntime as ort
-        model_path = 'models/face_embedding.onnx'
-        
-        if not os.path.exists(model_path):
-            print(f"✗ Model file not found: {model_path}")
-            return False
         
         print(f"\nLoading model with ONNX Runtime...")
         print(f"ONNX Runtime version: {ort.__version__}")
         print(f"Available providers: {ort.get_available_providers()}")
         
-        sess_options = ort.SessionOptions()
-        sess_options.intra_op_num_threads = 1
-        sess_options.inter_op_num_threads = 1
-        
-        session = ort.InferenceSession(
-            model_path,
-            sess_options=sess_options,
-            providers=['CPUExecutionProvider']
-        )
+        session = get_session(model_path, model_bytes)
         
         print("✓ Model loaded successfully with ONNX Runtime")
         print(f"  Active providers: {session.get_providers()}")
@@ -90,8 +102,8 @@ def check_model_with_onnxruntime():
         return False
     except Exception as e:
         print(f"✗ ONNX Runtime loading failed: {e}")
-        import traceback
-        traceback.print_exc()
+        if DEBUG:
+            traceback.print_exc()
         return False
 
 def main():
@@ -109,16 +121,16 @@ def main():
     print(f"\nModel file: {os.path.abspath(model_path)}")
     print(f"Size: {file_size:.2f} MB")
     
-    # Check file header
+    # Read the model once and share the bytes between both validators
     with open(model_path, 'rb') as f:
-        header = f.read(16)
-        print(f"Header (hex): {header.hex()}")
+        model_bytes = f.read()
+    print(f"Header (hex): {model_bytes[:16].hex()}")
     
     # Try ONNX library check
-    onnx_ok = check_model_with_onnx()
+    onnx_ok = check_model_with_onnx(model_bytes)
     
     # Try ONNX Runtime check
-    ort_ok = check_model_with_onnxruntime()
+    ort_ok = check_model_with_onnxruntime(model_path, model_bytes)
     
     print("\n" + "=" * 60)
     if onnx_ok and ort_ok:
@@ -2,8 +2,11 @@
 Configuration management using Pydantic Settings
 All secrets are loaded from environment variables
 """
-from pydantic_settings import BaseSettings
+from pydantic import ValidationError
+from pydantic_settings import BaseSettings, SettingsConfigDict
 from functools import lru_cache
+from typing import Optional
+import os
 
 
 class Settings(BaseSettings):
@@ -13,30 +16,101 @@ class Settings(BaseSettings):
     supabase_url: str
     supabase_key: str
     
+    # Supabase HTTP connection pool (shared keep-alive connections)
+    http_max_keepalive_connections: int = 20
+    http_max_connections: int = 40
+    
+    # Direct PostgreSQL connection (optional) - enables pooled bulk reads
+    database_url: Optional[str] = None
+    db_pool_min_size: int = 2
+    db_pool_max_size: int = 10
+    
+    # Server-side KNN with pgvector (requires database_url and the emb column)
+    pgvector_enabled: bool = False
+    # Declared dimension of the emb vector(N) column; must match the model
+    pgvector_dim: int = 512
+    
     # Face Recognition
     confidence_threshold: float = 0.80
+    
+    # Decoded images are downscaled to this longest side (0 = keep full size)
+    max_image_dim: int = 640
     max_attendance_per_day: int = 2
     
+    # Seconds before the in-process embedding matrix is reloaded from the DB
+    embedding_cache_ttl: float = 60.0
+    
+    # Keep the in-process gallery as int8 (4x less RAM) and score with int8 cosine
+    gallery_int8: bool = False
+    
+    # Directory for the memory-mapped gallery file (None = in-memory matrix)
+    gallery_path: Optional[str] = None
+    
+    # Galleries with at least this many rows use a FAISS HNSW index when faiss
+    # is installed (0 = always exact scan; below ~20k the scan is as fast)
+    ann_min_gallery_size: int = 20000
+    
     # Server
     host: str = "0.0.0.0"
     port: int = 8000
     workers: int = 1
     
+    # ONNX Runtime intra-op threads per worker (0 = auto: cpu_count // workers)
+    onnx_intra_op_threads: int = 0
+    
+    # Micro-batching: concurrent requests within the window share one ORT call
+    batch_window_ms: float = 5.0
+    max_batch_size: int = 16
+    
+    # Embeddings of recently seen images kept per worker (0 = disabled)
+    embedding_lru_size: int = 512
+    
     # Security
     api_key: str
     
     # Debug
     debug: bool = False
     
-    class Config:
-        env_file = ".env"
-        case_sensitive = False
+    # Immutable after load - settings are shared across requests
+    model_config = SettingsConfigDict(
+        env_file=".env",
+        case_sensitive=False,
+        frozen=True
+    )
 
 
-@lru_cache()
+@lru_cache(maxsize=1)
 def get_settings() -> Settings:
     """
     Cached settings instance
     Only loads once and reuses across requests
     """
     return Settings()
+
+
+def onnx_thread_count() -> int:
+    """
+    Intra-op thread count for ONNX Runtime sessions
+    
+    Splits the available cores across uvicorn workers so each worker's
+    Conv/GEMM kernels use its share without oversubscribing the CPU
+    (1 thread on a 1 vCPU VM). Falls back to a single worker's share when
+    settings can't be loaded, e.g. model checks run without a .env.
+    """
+    try:
+        settings = get_settings()
+    except ValidationError:
+        return max(1, os.cpu_count() or 1)
+    
+    if settings.onnx_intra_op_threads > 0:
+        return settings.onnx_intra_op_threads
+    return max(1, (os.cpu_count() or 1) // max(1, settings.workers))
+
+
+# Parse and validate settings at import so the first request doesn't pay for it.
+# If required variables are missing, the error surfaces on the first
+# get_settings() call instead (lru_cache does not cache exceptions).
+try:
+    get_settings()
+except ValidationError:
+    pass
@@ -3,24 +3,101 @@ Supabase database integration
 Handles all database operations for face embeddings and attendance records
 """
 from supabase import create_client, Client  # type: ignore
-from typing import Optional, List, Dict, Any
+from postgrest.types import ReturnMethod  # type: ignore
+from postgrest.exceptions import APIError  # type: ignore
+from psycopg import errors as pg_errors
+from psycopg_pool import AsyncConnectionPool
+import httpx
+from typing import Optional, List, Dict, Any, Tuple, AsyncIterator
 import numpy as np
-import json
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
+import asyncio
 import logging
+import threading
+import time
+from functools import lru_cache
 from config import get_settings
+from embedding_codec import encode_embedding, decode_embedding, decode_embedding_batch, decode_embedding_batch_i8, quantize_embedding, to_vector_literal
+from gallery_store import GalleryStore
+
+try:
+    # HTTP/2 support for httpx (pip install h2, or httpx[http2])
+    import h2  # noqa: F401
+    _HTTP2 = True
+except ImportError:
+    # Falls back to pooled HTTP/1.1 keep-alive connections
+    _HTTP2 = False
 
 logger = logging.getLogger(__name__)
 
+# (epoch second, ISO string) - replaced atomically, refreshed once per second
+_ts_cache = (0, '')
+
+
+def _now_iso() -> str:
+    """
+    Current UTC time as an ISO-8601 string, cached per second
+    
+    Avoids building a datetime and formatting it on every write in a burst.
+    """
+    global _ts_cache
+    second = int(time.time())
+    cached_second, cached_value = _ts_cache
+    if cached_second != second:
+        cached_value = datetime.utcfromtimestamp(second).isoformat()
+        _ts_cache = (second, cached_value)
+    return cached_value
+
 
 class Database:
     """
     Database handler for Supabase PostgreSQL
     Manages face embeddings and attendance records
+    
+    Per-request queries are coroutines: they run on the async direct pool
+    when DATABASE_URL is set, otherwise the blocking Supabase call is moved
+    to a worker thread so the event loop keeps serving other requests.
     """
     
     _instance = None
+    _initialized = False
     _client: Optional[Client] = None
+    _pool: Optional[AsyncConnectionPool] = None
+    
+    # Per-swipe queries run as server-side prepared statements on the direct pool
+    _count_today_stmt = (
+        "SELECT count(*) FROM attendance "
+        "WHERE user_id = %s AND timestamp >= %s AND timestamp < %s"
+    )
+    _insert_attendance_stmt = (
+        "INSERT INTO attendance (user_id, name, timestamp, confidence) "
+        "VALUES (%s, %s, %s, %s) RETURNING id"
+    )
+    _mark_attendance_stmt = (
+        "SELECT attendance_id, count_today "
+        "FROM mark_attendance_if_allowed(%s, %s, %s, %s, %s, %s, %s)"
+    )
+    
+    # Cleared once the mark_attendance_if_allowed SQL function turns out to be missing
+    _attendance_rpc_available = True
+    
+    # In-process embedding matrix cache, rebuilt when the version changes
+    _embeddings_version = 0
+    _matrix_cache: Optional[Tuple[int, float, List[str], List[str], np.ndarray]] = None
+    # Preallocated rows behind the cached matrix; enrollments fill the spare ones
+    _matrix_buffer: Optional[np.ndarray] = None
+    # store_face_embedding() runs on worker threads, so concurrent enrollments
+    # patch and publish the cached matrix under this lock
+    _matrix_lock = threading.Lock()
+    # Enrollments patched into the cached matrix; a rebuild that overlapped
+    # one is returned but not cached, since it may predate the patch
+    _matrix_patches = 0
+    
+    # Optional memory-mapped gallery file backing the embedding matrix
+    _gallery_store: Optional[GalleryStore] = None
+    # One gallery file rebuild at a time; requests that miss the cache while
+    # it runs wait for it and reuse its result
+    _gallery_rebuild_lock = asyncio.Lock()
     
     def __new__(cls):
         """Singleton pattern"""
@@ -29,7 +106,10 @@ class Database:
         return cls._instance
     
     def __init__(self):
-        """Initialize Supabase client"""
+        """Initialize Supabase client (until a construction succeeds)"""
+        if Database._initialized:
+            return
+        
         if self._client is None:
             settings = get_settings()
             try:
@@ -37,11 +117,85 @@ class Database:
                     settings.supabase_url,
                     settings.supabase_key
                 )
+                # Only a working client ends initialization; after a failure
+                # the next Database() tries to connect again
+                Database._initialized = True
                 logger.info("Supabase client initialized successfully")
             except Exception as e:
                 logger.warning(f"Failed to initialize Supabase client: {e}")
                 logger.warning("Running in degraded mode - database operations will fail")
                 self._client = None
+            
+            if self._client is not None:
+                try:
+                    self._configure_http_pool(settings)
+                except Exception as e:
+                    # The client still works with supabase-py's own session
+                    logger.warning(f"Failed to configure HTTP connection pool, using the default session: {e}")
+            
+            if settings.gallery_path and self._gallery_store is None:
+                try:
+                    self._gallery_store = GalleryStore(settings.gallery_path)
+                    logger.info(f"Memory-mapped gallery at {settings.gallery_path}")
+                except OSError as e:
+                    logger.warning(f"Failed to open gallery directory, using in-memory matrix: {e}")
+    
+    def _configure_http_pool(self, settings) -> None:
+        """
+        Replace PostgREST's default HTTP session with a pooled keep-alive client
+        
+        supabase-py builds its httpx session with default limits; reusing a
+        sized connection pool avoids a TCP + TLS handshake per query. HTTP/2
+        is enabled when h2 is installed (httpx refuses http2=True without it).
+        """
+        postgrest = self._client.postgrest
+        session = postgrest.session
+        # Same class as the original session (a thin httpx.Client subclass)
+        postgrest.session = type(session)(
+            base_url=session.base_url,
+            headers=session.headers,
+            timeout=session.timeout,
+            http2=_HTTP2,
+            limits=httpx.Limits(
+                max_keepalive_connections=settings.http_max_keepalive_connections,
+                max_connections=settings.http_max_connections,
+                keepalive_expiry=60
+            )
+        )
+        session.close()
+    
+    async def open_pool(self) -> None:
+        """
+        Open the async direct PostgreSQL connection pool (application startup)
+        
+        Must run inside the event loop, so it is not done in __init__.
+        No-op without DATABASE_URL. Failure is not fatal - queries fall
+        back to the Supabase client.
+        """
+        settings = get_settings()
+        if not settings.database_url or self._pool is not None:
+            return
+        
+        pool = AsyncConnectionPool(
+            settings.database_url,
+            min_size=settings.db_pool_min_size,
+            max_size=settings.db_pool_max_size,
+            timeout=30,
+            open=False
+        )
+        try:
+            await pool.open(wait=True)
+            self._pool = pool
+            logger.info("PostgreSQL connection pool initialized")
+        except Exception as e:
+            logger.warning(f"Failed to initialize PostgreSQL connection pool: {e}")
+            await pool.close()
+    
+    async def close_pool(self) -> None:
+        """Close the async direct PostgreSQL connection pool (application shutdown)"""
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await pool.close()
     
     def store_face_embedding(
         self,
@@ -65,32 +219,51 @@ class Database:
             return False
             
         try:
-            # Convert embedding to list for JSON storage
-            embedding_list = embedding.tolist()
-            
-            # Check if user already exists
-            existing = self._client.table('face_embeddings').select('*').eq('user_id', user_id).execute()
-            
-            if existing.data:
-                # Update existing embedding
-                result = self._client.table('face_embeddings').update({
-                    'name': name,
-                    'embedding': json.dumps(embedding_list),
-                    'updated_at': datetime.utcnow().isoformat()
-                }).eq('user_id', user_id).execute()
-                
-                logger.info(f"Updated embedding for user: {user_id}")
-            else:
-                # Insert new embedding
-                result = self._client.table('face_embeddings').insert({
-                    'user_id': user_id,
-                    'name': name,
-                    'embedding': json.dumps(embedding_list),
-                    'created_at': datetime.utcnow().isoformat(),
-                    'updated_at': datetime.utcnow().isoformat()
-                }).execute()
-                
-                logger.info(f"Inserted new embedding for user: {user_id}")
+            # Normalize once here so every reader can score with a plain dot product
+            norm = float(np.linalg.norm(embedding))
+            if norm > 1e-8:
+                embedding = (embedding / norm).astype(np.float32)
+            
+            # Encode embedding as int8 bytes + per-vector scale for BYTEA storage
+            encoded, scale = encode_embedding(embedding)
+            
+            row = {
+                'user_id': user_id,
+                'name': name,
+                'embedding': encoded,
+                'embedding_scale': scale,
+                'updated_at': _now_iso()
+            }
+            settings = get_settings()
+            if settings.pgvector_enabled:
+                if len(embedding) == settings.pgvector_dim:
+                    row['emb'] = to_vector_literal(embedding)
+                else:
+                    # Postgres would reject the whole upsert for a vector(N) mismatch
+                    logger.warning(
+                        f"Embedding for {user_id} has {len(embedding)} dimensions but the emb "
+                        f"column is vector({settings.pgvector_dim}); storing it without emb"
+                    )
+            
+            # Single-round-trip UPSERT keyed on user_id
+            # created_at is only set on insert by the column's DEFAULT NOW()
+            self._client.table('face_embeddings').upsert(
+                row, on_conflict='user_id', returning=ReturnMethod.minimal
+            ).execute()
+            
+            logger.info(f"Stored embedding for user: {user_id}")
+            
+            # Patch the cached embedding matrix (or memory-mapped gallery) in
+            # place; otherwise (or if that fails) invalidate it
+            with self._matrix_lock:
+                if self._gallery_store is not None:
+                    updated = self._update_gallery_store(user_id, name, embedding)
+                else:
+                    updated = self._update_matrix_cache(user_id, name, embedding)
+                if updated:
+                    self._matrix_patches += 1
+                else:
+                    self._embeddings_version += 1
             
             return True
             
@@ -98,65 +271,466 @@ class Database:
             logger.error(f"Failed to store face embedding: {e}")
             return False
     
-    def get_face_embedding(self, user_id: str) -> Optional[np.ndarray]:
+    def _update_gallery_store(self, user_id: str, name: str, embedding: np.ndarray) -> bool:
+        """
+        Write a newly stored embedding into the gallery file and remap it
+        
+        Called with _matrix_lock held.
+        
+        Returns:
+            True if the cached matrix now includes the embedding
+        """
+        store = self._gallery_store
+        if store is None or self._matrix_cache is None:
+            return False
+        
+        row = self._gallery_row(embedding)
+        try:
+            if not store.upsert(user_id, name, row):
+                return False
+            loaded = store.load()
+        except OSError as e:
+            logger.warning(f"Failed to update gallery file: {e}")
+            return False
+        
+        if loaded is None:
+            return False
+        
+        version, built_at = self._matrix_cache[0], self._matrix_cache[1]
+        self._matrix_cache = (version, built_at, *loaded)
+        return True
+    
+    def _update_matrix_cache(self, user_id: str, name: str, embedding: np.ndarray) -> bool:
+        """
+        Add a newly stored embedding to the cached in-memory matrix
+        
+        A new user is written into the next spare row of the preallocated
+        buffer (doubled when full), so an enrollment costs one row copy
+        instead of a full reload. Re-enrolling an existing user replaces
+        their row in a copy, so a matrix that is already being scored never
+        changes underneath the reader. The id and name lists are rebuilt
+        rather than appended to for the same reason. Called with
+        _matrix_lock held.
+        
+        Returns:
+            True if the cached matrix now includes the embedding
         """
-        Retrieve face embedding for a user
+        cache = self._matrix_cache
+        if cache is None or cache[0] != self._embeddings_version:
+            return False
+        
+        version, built_at, user_ids, names, matrix = cache
+        row = self._gallery_row(embedding)
+        if row.shape != matrix.shape[1:] or row.dtype != matrix.dtype:
+            return False
+        
+        try:
+            i = user_ids.index(user_id)
+        except ValueError:
+            i = -1
+        
+        if i >= 0:
+            matrix = self._matrix_buffer = matrix.copy()
+            matrix[i] = row
+            names = names.copy()
+            names[i] = name
+        else:
+            n = len(user_ids)
+            buffer = self._matrix_buffer
+            if buffer is None or buffer.shape[0] <= n:
+                grown = np.empty((max(2 * n, 16), matrix.shape[1]), dtype=matrix.dtype)
+                grown[:n] = matrix
+                buffer = self._matrix_buffer = grown
+            buffer[n] = row
+            matrix = buffer[:n + 1]
+            user_ids = user_ids + [user_id]
+            names = names + [name]
+        
+        self._matrix_cache = (version, built_at, user_ids, names, matrix)
+        return True
+    
+    @staticmethod
+    def _gallery_row(embedding: np.ndarray) -> np.ndarray:
+        """Normalized embedding in the gallery's dtype (int8 with GALLERY_INT8)"""
+        if get_settings().gallery_int8:
+            return quantize_embedding(embedding)[0]
+        return embedding.astype(np.float32, copy=False)
+    
+    def get_face_embedding(self, user_id: str) -> Optional[Tuple[np.ndarray, str]]:
+        """
+        Retrieve face embedding and name for a user in one query
         
         Args:
             user_id: User identifier
             
         Returns:
-            Embedding vector or None if not found
+            Tuple of (embedding vector, name) or None if not found
         """
         if self._client is None:
             logger.error("Database client not initialized. Cannot retrieve face embedding.")
             return None
             
         try:
-            result = self._client.table('face_embeddings').select('embedding').eq('user_id', user_id).execute()
+            result = self._client.table('face_embeddings').select('embedding, embedding_scale, name').eq('user_id', user_id).execute()
             
             if not result.data:
                 logger.warning(f"No embedding found for user: {user_id}")
                 return None
             
-            # Parse JSON embedding
-            embedding_json = result.data[0]['embedding']
-            embedding_list = json.loads(embedding_json)
-            embedding = np.array(embedding_list, dtype=np.float32)
+            # Decode BYTEA embedding (dequantizes int8 rows)
+            row = result.data[0]
+            embedding = decode_embedding(row['embedding'], row.get('embedding_scale'))
             
             logger.debug(f"Retrieved embedding for user: {user_id}")
-            return embedding
+            return embedding, row['name']
             
         except Exception as e:
             logger.error(f"Failed to retrieve face embedding: {e}")
             return None
     
-    def get_all_face_embeddings(self) -> List[Dict[str, Any]]:
+    async def _iter_direct(self, batch_size: int) -> AsyncIterator[List[Dict[str, Any]]]:
+        """Page through face_embeddings with a server-side cursor on the direct pool"""
+        async with self._pool.connection() as conn:
+            async with conn.cursor(name='face_embeddings_scan') as cur:
+                cur.itersize = batch_size
+                await cur.execute("SELECT user_id, name, embedding, embedding_scale FROM face_embeddings")
+                while True:
+                    rows = await cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield [
+                        {'user_id': user_id, 'name': name, 'embedding': embedding, 'embedding_scale': scale}
+                        for user_id, name, embedding, scale in rows
+                    ]
+    
+    async def _iter_postgrest(self, batch_size: int) -> AsyncIterator[List[Dict[str, Any]]]:
+        """Page through face_embeddings with PostgREST .range() requests"""
+        start = 0
+        while True:
+            query = self._client.table('face_embeddings').select(
+                'user_id, name, embedding, embedding_scale'
+            ).order('user_id').range(start, start + batch_size - 1)
+            result = await asyncio.to_thread(query.execute)
+            
+            page = result.data or []
+            if page:
+                yield page
+            
+            # A short page means the table is exhausted
+            if len(page) < batch_size:
+                break
+            start += batch_size
+    
+    def iter_face_embeddings(self, batch_size: int = 1000) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        Stream all face embeddings in pages (async iterator)
+        
+        PostgREST caps a single response (1000 rows by default) and silently
+        truncates the rest, so rows are fetched page by page until a short
+        page comes back. Uses the direct pool's server-side cursor if configured.
+        
+        Args:
+            batch_size: Rows per page
+            
+        Yields:
+            Lists of raw row dicts (user_id, name, embedding, embedding_scale);
+            decode a page with decode_embeddings()
+            
+        Raises:
+            RuntimeError: If no database connection is available
+            Exception: Database errors are propagated to the caller
+        """
+        if self._pool is not None:
+            return self._iter_direct(batch_size)
+        if self._client is None:
+            raise RuntimeError("Database client not initialized")
+        return self._iter_postgrest(batch_size)
+    
+    @staticmethod
+    def decode_embeddings(rows: List[Dict[str, Any]]) -> np.ndarray:
+        """
+        Decode a page of raw rows into one (N, D) float32 matrix
+        
+        Args:
+            rows: Row dicts with embedding and embedding_scale columns
+            
+        Returns:
+            C-contiguous float32 matrix, one row per input row
+        """
+        return decode_embedding_batch(
+            [row['embedding'] for row in rows],
+            [row.get('embedding_scale') for row in rows]
+        )
+    
+    @staticmethod
+    def decode_embeddings_i8(rows: List[Dict[str, Any]]) -> np.ndarray:
+        """
+        Decode a page of raw rows into one (N, D) int8 matrix (no dequantization)
+        
+        Args:
+            rows: Row dicts with embedding and embedding_scale columns
+            
+        Returns:
+            C-contiguous int8 matrix, one row per input row
+        """
+        return decode_embedding_batch_i8(
+            [row['embedding'] for row in rows],
+            [row.get('embedding_scale') for row in rows]
+        )
+    
+    async def _decode_pages(self, pages: AsyncIterator[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """Flatten pages into row dicts whose embedding is a row view of the page matrix"""
+        rows = []
+        async for page in pages:
+            matrix = self.decode_embeddings(page)
+            for row, embedding in zip(page, matrix):
+                row['embedding'] = embedding
+                row.pop('embedding_scale', None)
+            rows.extend(page)
+        return rows
+    
+    async def count_face_embeddings(self) -> int:
+        """
+        Count enrolled face embeddings server-side
+        
+        Returns:
+            Number of rows in face_embeddings (0 if unavailable)
+        """
+        try:
+            if self._pool is not None:
+                async with self._pool.connection() as conn:
+                    cur = await conn.execute("SELECT count(*) FROM face_embeddings")
+                    return (await cur.fetchone())[0]
+            
+            if self._client is None:
+                return 0
+            
+            query = self._client.table('face_embeddings').select('user_id', count='exact').limit(1)
+            result = await asyncio.to_thread(query.execute)
+            return result.count or 0
+            
+        except Exception as e:
+            logger.error(f"Failed to count face embeddings: {e}")
+            return 0
+    
+    async def get_all_face_embeddings(self) -> List[Dict[str, Any]]:
         """
         Retrieve all face embeddings from database
         
         Returns:
-            List of dicts with user_id, name, and embedding
+            List of dicts with user_id, name, and decoded embedding vector
         """
+        if self._pool is not None:
+            try:
+                rows = await self._decode_pages(self._iter_direct(1000))
+                logger.debug(f"Retrieved {len(rows)} face embeddings (direct)")
+                return rows
+            except Exception as e:
+                logger.warning(f"Direct embedding read failed, falling back to Supabase: {e}")
+        
         if self._client is None:
             logger.error("Database client not initialized")
             return []
             
         try:
-            result = self._client.table('face_embeddings').select('user_id, name, embedding').execute()
+            rows = await self._decode_pages(self._iter_postgrest(1000))
             
-            if not result.data:
+            if not rows:
                 logger.info("No face embeddings found in database")
                 return []
             
-            logger.debug(f"Retrieved {len(result.data)} face embeddings")
-            return result.data
+            logger.debug(f"Retrieved {len(rows)} face embeddings")
+            return rows
             
         except Exception as e:
             logger.error(f"Failed to retrieve all face embeddings: {e}")
             return []
     
-    def get_attendance_count_today(self, user_id: str) -> int:
+    async def load_embedding_matrix(self) -> Tuple[List[str], List[str], np.ndarray]:
+        """
+        Load all face embeddings as a single contiguous matrix
+        
+        The matrix is cached in-process. Embeddings stored by this worker
+        are patched into it, and it is rebuilt only once the cache TTL
+        expires (so that enrollments made by other workers become visible)
+        or a patch is not possible. Rows are streamed
+        page by page into a buffer preallocated from a COUNT probe, so peak
+        memory stays at one matrix plus one page. Embeddings are normalized
+        at store time, so no per-load normalization pass is needed.
+        
+        With GALLERY_INT8 the matrix keeps the stored int8 values instead
+        (4x smaller); FaceRecognitionEngine.match() scores it with int8
+        cosine kernels.
+        
+        With GALLERY_PATH the rows are streamed into a flat file instead of
+        a RAM buffer and the returned matrix is a read-only numpy.memmap of
+        it, so the OS pages the gallery in on demand. A gallery file written
+        by another worker within the TTL is mapped without querying the DB.
+        
+        Returns:
+            Tuple of (user_ids, names, matrix) where matrix is a C-contiguous
+            float32 array of shape (N, D) with L2-normalized rows, or an
+            int8 array of shape (N, D) with GALLERY_INT8
+        """
+        if self._gallery_store is not None:
+            return await self._load_gallery_store()
+        
+        cached = self._fresh_matrix_cache()
+        if cached is not None:
+            return cached
+        
+        settings = get_settings()
+        version, patches = self._embeddings_version, self._matrix_patches
+        if settings.gallery_int8:
+            dtype, decode = np.int8, self.decode_embeddings_i8
+        else:
+            dtype, decode = np.float32, self.decode_embeddings
+        user_ids: List[str] = []
+        names: List[str] = []
+        matrix: Optional[np.ndarray] = None
+        filled = 0
+        
+        try:
+            capacity = await self.count_face_embeddings()
+            async for page in self.iter_face_embeddings():
+                block = decode(page)
+                
+                if matrix is None:
+                    matrix = np.empty((max(capacity, len(page)), block.shape[1]), dtype=dtype)
+                elif filled + len(page) > matrix.shape[0]:
+                    # Rows were added after the COUNT probe - grow the buffer
+                    grown = np.empty((max(2 * matrix.shape[0], filled + len(page)), matrix.shape[1]), dtype=dtype)
+                    grown[:filled] = matrix[:filled]
+                    matrix = grown
+                
+                matrix[filled:filled + len(page)] = block
+                filled += len(page)
+                user_ids.extend(row['user_id'] for row in page)
+                names.extend(row['name'] for row in page)
+        except Exception as e:
+            logger.error(f"Failed to load embedding matrix: {e}")
+            return [], [], np.empty((0, 0), dtype=np.float32)
+        
+        if matrix is None:
+            # Don't cache empty results - the table may be filled by another worker
+            return [], [], np.empty((0, 0), dtype=np.float32)
+        
+        # Leading-row slice of a C-contiguous buffer is still C-contiguous;
+        # rows past `filled` are spare capacity for later enrollments
+        buffer, matrix = matrix, matrix[:filled]
+        
+        with self._matrix_lock:
+            if self._matrix_patches == patches:
+                self._matrix_buffer = buffer
+                self._matrix_cache = (version, time.monotonic(), user_ids, names, matrix)
+        logger.info(f"Built embedding matrix: {matrix.shape[0]} x {matrix.shape[1]}")
+        return user_ids, names, matrix
+    
+    def _fresh_matrix_cache(self) -> Optional[Tuple[List[str], List[str], np.ndarray]]:
+        """The cached (user_ids, names, matrix) if current and within the TTL"""
+        cache = self._matrix_cache
+        if (
+            cache is not None
+            and cache[0] == self._embeddings_version
+            and time.monotonic() - cache[1] < get_settings().embedding_cache_ttl
+        ):
+            return cache[2], cache[3], cache[4]
+        return None
+    
+    async def _load_gallery_store(self) -> Tuple[List[str], List[str], np.ndarray]:
+        """load_embedding_matrix() backed by the memory-mapped gallery file"""
+        cached = self._fresh_matrix_cache()
+        if cached is not None:
+            return cached
+        
+        async with self._gallery_rebuild_lock:
+            # Another request may have rebuilt the gallery while this one waited
+            cached = self._fresh_matrix_cache()
+            if cached is not None:
+                return cached
+            return await self._rebuild_gallery_store()
+    
+    async def _rebuild_gallery_store(self) -> Tuple[List[str], List[str], np.ndarray]:
+        """Map the gallery file, rebuilding it from the database if stale; _gallery_rebuild_lock held"""
+        settings = get_settings()
+        store = self._gallery_store
+        version, patches = self._embeddings_version, self._matrix_patches
+        dtype = np.dtype(np.int8 if settings.gallery_int8 else np.float32)
+        
+        # A file refreshed by another worker within the TTL is current enough
+        loaded = store.load() if store.age() < settings.embedding_cache_ttl else None
+        if loaded is not None and loaded[2].dtype != dtype:
+            loaded = None
+        
+        if loaded is None:
+            decode = self.decode_embeddings_i8 if settings.gallery_int8 else self.decode_embeddings
+            writer = store.writer(dtype)
+            try:
+                async for page in self.iter_face_embeddings():
+                    writer.append(
+                        [row['user_id'] for row in page],
+                        [row['name'] for row in page],
+                        decode(page)
+                    )
+                writer.commit()
+            except Exception as e:
+                writer.abort()
+                logger.error(f"Failed to rebuild gallery file: {e}")
+                return [], [], np.empty((0, 0), dtype=np.float32)
+            
+            loaded = store.load()
+            if loaded is None:
+                # Empty table - don't cache, it may be filled by another worker
+                return [], [], np.empty((0, 0), dtype=np.float32)
+            logger.info(f"Built gallery file: {loaded[2].shape[0]} x {loaded[2].shape[1]}")
+        
+        user_ids, names, matrix = loaded
+        with self._matrix_lock:
+            if self._matrix_patches == patches:
+                self._matrix_cache = (version, time.monotonic(), user_ids, names, matrix)
+        return user_ids, names, matrix
+    
+    async def nearest(self, query: np.ndarray, k: int = 1) -> Optional[List[Tuple[str, str, float]]]:
+        """
+        Server-side KNN over the pgvector emb column
+        
+        The HNSW index returns the top-k candidates, so only k rows cross
+        the network instead of every stored embedding.
+        
+        Args:
+            query: Query embedding vector
+            k: Number of nearest neighbours to return
+            
+        Returns:
+            List of (user_id, name, cosine_similarity) ordered best-first,
+            or None if pgvector search is unavailable (caller should fall
+            back to load_embedding_matrix)
+        """
+        settings = get_settings()
+        if self._pool is None or not settings.pgvector_enabled:
+            return None
+        if len(query) != settings.pgvector_dim:
+            # emb only holds embeddings of the declared size
+            return None
+        
+        try:
+            vector = to_vector_literal(query)
+            async with self._pool.connection() as conn:
+                cur = await conn.execute(
+                    "SELECT user_id, name, 1 - (emb <=> %s::vector) AS score "
+                    "FROM face_embeddings WHERE emb IS NOT NULL "
+                    "ORDER BY emb <=> %s::vector LIMIT %s",
+                    (vector, vector, k)
+                )
+                rows = await cur.fetchall()
+            
+            return [(user_id, name, float(score)) for user_id, name, score in rows]
+            
+        except Exception as e:
+            logger.warning(f"pgvector search failed, falling back to in-process matrix: {e}")
+            return None
+    
+    async def get_attendance_count_today(self, user_id: str) -> int:
         """
         Get number of attendance records for user today
         
@@ -166,6 +740,22 @@ class Database:
         Returns:
             Count of attendance records today
         """
+        if self._pool is not None:
+            try:
+                today = date.today()
+                async with self._pool.connection() as conn:
+                    cur = await conn.execute(
+                        self._count_today_stmt,
+                        (user_id, today.isoformat(), (today + timedelta(days=1)).isoformat()),
+                        prepare=True
+                    )
+                    count = (await cur.fetchone())[0]
+                
+                logger.debug(f"User {user_id} has {count} attendance records today (direct)")
+                return count
+            except Exception as e:
+                logger.warning(f"Direct attendance count failed, falling back to Supabase: {e}")
+        
         if self._client is None:
             logger.error("Database client not initialized. Cannot get attendance count.")
             return 0
@@ -173,9 +763,12 @@ class Database:
         try:
             today = date.today().isoformat()
             
-            result = self._client.table('attendance').select('id').eq('user_id', user_id).gte('timestamp', f"{today}T00:00:00").lte('timestamp', f"{today}T23:59:59").execute()
+            # Server-side COUNT (returned in Content-Range); at most one row in the body.
+            # Pinned postgrest-py has no head=True and drops the count on empty bodies.
+            query = self._client.table('attendance').select('id', count='exact').eq('user_id', user_id).gte('timestamp', f"{today}T00:00:00").lte('timestamp', f"{today}T23:59:59").limit(1)
+            result = await asyncio.to_thread(query.execute)
             
-            count = len(result.data)
+            count = result.count or 0
             logger.debug(f"User {user_id} has {count} attendance records today")
             return count
             
@@ -183,7 +776,7 @@ class Database:
             logger.error(f"Failed to get attendance count: {e}")
             return 0
     
-    def insert_attendance(
+    async def insert_attendance(
         self,
         user_id: str,
         name: str,
@@ -200,17 +793,35 @@ class Database:
         Returns:
             Attendance record ID or None if failed
         """
+        if self._pool is not None:
+            # No PostgREST fallback here - retrying a failed INSERT could record it twice
+            try:
+                async with self._pool.connection() as conn:
+                    cur = await conn.execute(
+                        self._insert_attendance_stmt,
+                        (user_id, name, _now_iso(), confidence),
+                        prepare=True
+                    )
+                    attendance_id = (await cur.fetchone())[0]
+                
+                logger.info(f"Inserted attendance for user {user_id} with ID: {attendance_id}")
+                return str(attendance_id)
+            except Exception as e:
+                logger.error(f"Failed to insert attendance: {e}")
+                return None
+        
         if self._client is None:
             logger.error("Database client not initialized. Cannot insert attendance.")
             return None
             
         try:
-            result = self._client.table('attendance').insert({
+            query = self._client.table('attendance').insert({
                 'user_id': user_id,
                 'name': name,
-                'timestamp': datetime.utcnow().isoformat(),
+                'timestamp': _now_iso(),
                 'confidence': confidence
-            }).execute()
+            })
+            result = await asyncio.to_thread(query.execute)
             
             if result.data:
                 attendance_id = result.data[0]['id']
@@ -223,6 +834,77 @@ class Database:
             logger.error(f"Failed to insert attendance: {e}")
             return None
     
+    async def try_mark_attendance(
+        self,
+        user_id: str,
+        name: str,
+        confidence: float,
+        max_per_day: int
+    ) -> Tuple[Optional[str], int]:
+        """
+        Insert an attendance record unless today's limit is already reached
+        
+        One round trip through the mark_attendance_if_allowed SQL function
+        (supabase_schema.sql), which counts and inserts under a per-user
+        lock, so concurrent requests can't exceed the limit. Falls back to
+        get_attendance_count_today() + insert_attendance() on databases
+        where the function is not installed yet.
+        
+        Args:
+            user_id: User identifier
+            name: User's name
+            confidence: Recognition confidence score
+            max_per_day: Maximum attendance records per day
+            
+        Returns:
+            Tuple of (attendance record ID, count of today's records before
+            this call). The ID is None if the limit was reached or the
+            insert failed.
+        """
+        if self._attendance_rpc_available:
+            today = date.today()
+            params = (
+                user_id, name, confidence, _now_iso(),
+                today.isoformat(), (today + timedelta(days=1)).isoformat(), max_per_day
+            )
+            try:
+                attendance_id, count = await self._mark_attendance(params)
+                if attendance_id is not None:
+                    logger.info(f"Inserted attendance for user {user_id} with ID: {attendance_id}")
+                return attendance_id, count
+            except (pg_errors.UndefinedFunction, APIError) as e:
+                if isinstance(e, APIError) and e.code not in ('PGRST202', '42883'):
+                    logger.error(f"Failed to mark attendance: {e}")
+                    return None, 0
+                logger.warning("mark_attendance_if_allowed() not installed - using count + insert")
+                Database._attendance_rpc_available = False
+            except Exception as e:
+                # No retry - the function may have inserted before the error
+                logger.error(f"Failed to mark attendance: {e}")
+                return None, 0
+        
+        count = await self.get_attendance_count_today(user_id)
+        if count >= max_per_day:
+            return None, count
+        return await self.insert_attendance(user_id=user_id, name=name, confidence=confidence), count
+    
+    async def _mark_attendance(self, params: tuple) -> Tuple[Optional[str], int]:
+        """Call mark_attendance_if_allowed() over the direct pool or PostgREST RPC"""
+        if self._pool is not None:
+            async with self._pool.connection() as conn:
+                cur = await conn.execute(self._mark_attendance_stmt, params, prepare=True)
+                attendance_id, count = await cur.fetchone()
+        else:
+            if self._client is None:
+                raise RuntimeError("Database client not initialized")
+            keys = ('p_user_id', 'p_name', 'p_confidence', 'p_timestamp', 'p_day_start', 'p_day_end', 'p_max_per_day')
+            query = self._client.rpc('mark_attendance_if_allowed', dict(zip(keys, params)))
+            result = await asyncio.to_thread(query.execute)
+            row = result.data[0]
+            attendance_id, count = row['attendance_id'], row['count_today']
+        
+        return (str(attendance_id) if attendance_id is not None else None), int(count)
+    
     def test_connection(self) -> bool:
         """
         Test database connection
@@ -244,5 +926,10 @@ class Database:
             return False
 
 
-# Global instance
-database = Database()
+@lru_cache(maxsize=1)
+def get_database() -> Database:
+    """
+    Shared Database instance (FastAPI dependency)
+    Created lazily on first use so workers don't connect at import time
+    """
+    return Database()
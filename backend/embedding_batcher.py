@@ -0,0 +1,90 @@
+"""
+Micro-batching of face embedding requests
+Coalesces concurrent requests into one ONNX Runtime call
+"""
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Set, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingBatcher:
+    """
+    Collects faces from concurrent requests for a short window and runs
+    them through FaceRecognitionEngine.embed_batch() in one call.
+
+    - The first face in a batch opens a window of `window_ms`
+    - The batch is flushed when the window closes or `max_batch_size` is reached
+    - Inference runs on a single dedicated thread, so the event loop stays
+      free and the engine is never entered concurrently
+    """
+
+    def __init__(self, engine, window_ms: float = 5.0, max_batch_size: int = 16):
+        self._engine = engine
+        self._window = window_ms / 1000.0
+        self._max_batch_size = max(1, max_batch_size)
+        self._pending: List[Tuple[np.ndarray, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # The event loop only holds weak references to tasks, so in-flight
+        # batches are kept here until they finish
+        self._tasks: Set[asyncio.Task] = set()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
+
+    async def embed(self, face: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Extract embedding for one face, batched with concurrent callers
+
+        Args:
+            face: RGB face image (H, W, 3)
+
+        Returns:
+            L2-normalized embedding vector or None if extraction failed
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((face, future))
+
+        if len(self._pending) >= self._max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self._window, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        """Hand the pending batch to the inference thread"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[np.ndarray, asyncio.Future]]) -> None:
+        """Run one batched inference and resolve each caller's future"""
+        loop = asyncio.get_running_loop()
+        faces = [face for face, _ in batch]
+
+        embeddings = []
+        try:
+            embeddings = await loop.run_in_executor(self._executor, self._engine.embed_batch, faces)
+        except Exception as e:
+            logger.error(f"Batched embedding failed for {len(faces)} face(s): {e}")
+        finally:
+            # Every caller is resolved, with None when the batch failed or
+            # was cancelled, so no request is left waiting
+            results = list(embeddings) + [None] * (len(batch) - len(embeddings))
+            for (_, future), embedding in zip(batch, results):
+                if not future.done():
+                    future.set_result(embedding)
+
+    def shutdown(self) -> None:
+        """Stop the inference thread"""
+        self._executor.shutdown(wait=False)
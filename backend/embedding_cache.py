@@ -0,0 +1,54 @@
+"""
+LRU cache of face embeddings keyed by image content
+Retried or resubmitted frames skip decode, detection and inference
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    Maps a BLAKE2b digest of the base64 image payload to its embedding
+
+    - Keys hash the payload after any data URL prefix, so the same image
+      sent with or without the prefix shares one entry
+    - Only successfully extracted embeddings are stored
+    - Cached arrays are read-only, since every hit returns the same object
+    """
+
+    def __init__(self, max_size: int = 512):
+        self._max_size = max_size
+        self._entries: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(image_b64: str) -> bytes:
+        """16-byte content digest of a base64 image string"""
+        data = image_b64.encode('ascii', errors='replace')
+        comma = data.find(b',')
+        return hashlib.blake2b(memoryview(data)[comma + 1:], digest_size=16).digest()
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        """Cached embedding for `key`, or None"""
+        if self._max_size <= 0:
+            return None
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+            return embedding
+
+    def put(self, key: bytes, embedding: np.ndarray) -> None:
+        """Store an embedding, evicting the least recently used entry when full"""
+        if self._max_size <= 0:
+            return
+        embedding.setflags(write=False)
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            if len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
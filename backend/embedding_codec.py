@@ -0,0 +1,159 @@
+"""
+Binary encoding for face embeddings stored in Supabase
+Embeddings travel as raw bytes (BYTEA) instead of JSON arrays
+
+Current rows hold int8 values plus a per-vector float32 scale
+(embedding_scale column) chosen so the decoded vector has unit L2 norm;
+rows without a scale hold raw float32 values.
+"""
+import numpy as np
+import orjson
+from typing import Any, Optional, Sequence, Tuple
+
+# Little-endian float32 - fixed on-disk layout regardless of host byte order
+EMBEDDING_DTYPE = np.dtype('<f4')
+
+
+def quantize_embedding(embedding: np.ndarray) -> Tuple[np.ndarray, float]:
+    """
+    Symmetric int8 quantization with a per-vector scale
+    
+    For L2-normalized embeddings the cosine similarity error is well below
+    recognition threshold granularity, while storage shrinks 4x.
+    
+    Args:
+        embedding: Float embedding vector
+        
+    Returns:
+        Tuple of (int8 vector, scale) where embedding ~= int8 vector * scale
+    """
+    peak = float(np.max(np.abs(embedding))) if embedding.size else 0.0
+    if peak == 0.0:
+        return np.zeros(embedding.shape, dtype=np.int8), 1.0
+    
+    scale = peak / 127.0
+    quantized = np.rint(embedding / scale).astype(np.int8)
+    return quantized, scale
+
+
+def to_vector_literal(embedding: np.ndarray) -> str:
+    """
+    Format embedding in pgvector's text input format ('[x1,x2,...]')
+    
+    orjson serializes the float32 array directly in C, without building
+    a list of Python floats first.
+    """
+    contiguous = np.ascontiguousarray(embedding, dtype=np.float32)
+    return orjson.dumps(contiguous, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+
+def _to_bytes(value: Any) -> Any:
+    """Normalize a BYTEA column value (raw bytes or '\\x' hex string) to a buffer"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return value
+    return bytes.fromhex(value[2:])
+
+
+def encode_embedding(embedding: np.ndarray) -> Tuple[str, float]:
+    """
+    Quantize embedding and encode it as a PostgreSQL BYTEA hex literal
+    
+    PostgREST passes JSON strings straight to the column, so a BYTEA value
+    must be sent in Postgres' hex input format ('\\x' followed by hex digits).
+    
+    The stored scale is 1 / ||q|| rather than the quantization step, so the
+    decoded vector is exactly unit-length and can be dot-product scored
+    without a normalization pass.
+    
+    Args:
+        embedding: Face embedding vector
+        
+    Returns:
+        Tuple of (BYTEA hex literal of the int8 values, embedding_scale)
+    """
+    quantized, _ = quantize_embedding(embedding)
+    quantized_norm = float(np.linalg.norm(quantized.astype(np.float32)))
+    scale = 1.0 / quantized_norm if quantized_norm > 0.0 else 1.0
+    return '\\x' + quantized.tobytes().hex(), scale
+
+
+def decode_embedding(value: Any, scale: Optional[float] = None) -> np.ndarray:
+    """
+    Decode a stored embedding back to a float32 vector
+    
+    Accepts raw bytes (direct Postgres drivers), BYTEA hex strings
+    (PostgREST) and legacy JSON array text written before the BYTEA migration.
+    
+    Args:
+        value: Column value as returned by the database
+        scale: embedding_scale column value; None for float32 rows
+        
+    Returns:
+        1D float32 embedding vector
+    """
+    if isinstance(value, str) and not value.startswith('\\x'):
+        # Legacy row: JSON array of floats
+        return np.array(orjson.loads(value), dtype=np.float32)
+    
+    if scale is not None:
+        quantized = np.frombuffer(_to_bytes(value), dtype=np.int8)
+        return quantized.astype(np.float32) * np.float32(scale)
+    
+    return np.frombuffer(_to_bytes(value), dtype=EMBEDDING_DTYPE)
+
+
+def decode_embedding_batch_i8(values: Sequence[Any], scales: Sequence[Optional[float]]) -> np.ndarray:
+    """
+    Decode a page of stored embeddings into one (N, D) int8 matrix
+    
+    int8 rows are taken as stored - no float32 matrix is ever built, so a
+    gallery held this way needs a quarter of the memory. The per-row scale
+    is dropped; cosine scoring normalizes each row anyway. Legacy float32
+    or JSON rows are quantized on the fly.
+    
+    Args:
+        values: embedding column values
+        scales: embedding_scale column values (None for float32 rows)
+        
+    Returns:
+        C-contiguous int8 matrix, one row per input value
+    """
+    rows = []
+    for value, scale in zip(values, scales):
+        if scale is not None:
+            rows.append(np.frombuffer(_to_bytes(value), dtype=np.int8))
+        else:
+            rows.append(quantize_embedding(decode_embedding(value))[0])
+    return np.vstack(rows)
+
+
+def decode_embedding_batch(values: Sequence[Any], scales: Sequence[Optional[float]]) -> np.ndarray:
+    """
+    Decode a page of stored embeddings into one (N, D) float32 matrix
+    
+    When every row is int8-quantized (the common case), all rows are
+    concatenated and decoded with a single np.frombuffer + one vectorized
+    rescale instead of N small per-row allocations. Pages that mix in
+    legacy float32/JSON rows fall back to per-row decoding.
+    
+    Args:
+        values: embedding column values
+        scales: embedding_scale column values (None for float32 rows)
+        
+    Returns:
+        C-contiguous float32 matrix, one row per input value
+    """
+    if values and all(scale is not None for scale in scales) and len({len(value) for value in values}) == 1:
+        if all(isinstance(value, str) and value.startswith('\\x') for value in values):
+            raw = bytes.fromhex(''.join(value[2:] for value in values))
+        elif all(isinstance(value, (bytes, bytearray, memoryview)) for value in values):
+            raw = b''.join(values)
+        else:
+            raw = None
+        
+        if raw is not None:
+            matrix = np.frombuffer(raw, dtype=np.int8).reshape(len(values), -1).astype(np.float32)
+            matrix *= np.asarray(scales, dtype=np.float32)[:, None]
+            return matrix
+    
+    return np.vstack([decode_embedding(value, scale) for value, scale in zip(values, scales)])
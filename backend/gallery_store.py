@@ -0,0 +1,207 @@
+"""
+Memory-mapped gallery of enrolled face embeddings
+Keeps the (N, D) matrix in a flat file so the OS pages it in on demand
+
+Layout (in GALLERY_PATH):
+- gallery.bin:        N * D values, row-major, no header
+- gallery_index.json: {"dim", "dtype", "user_ids", "names"} - row i of
+                      gallery.bin belongs to user_ids[i]
+
+Readers memory-map gallery.bin, so a match is one matrix-vector product
+straight over the mapping with no per-row Python objects. Writers take an
+exclusive flock on the index, so several uvicorn workers can share a
+gallery directory.
+"""
+import fcntl
+import logging
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+import numpy as np
+import orjson
+
+logger = logging.getLogger(__name__)
+
+
+def _open_temp_beside(path: str) -> Tuple[BinaryIO, str]:
+    """
+    Create a uniquely named temporary file next to path, for os.replace()
+
+    mkstemp() creates it 0600; it is widened to 0644 so the published file
+    stays readable like the one it replaces.
+    """
+    directory, name = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=f"{name}.", suffix='.tmp')
+    os.fchmod(fd, 0o644)
+    return os.fdopen(fd, 'wb'), tmp
+
+
+class GalleryWriter:
+    """
+    Streams a full gallery rebuild into temporary files
+
+    append() writes each decoded page straight to disk, so a rebuild holds
+    one page in memory rather than the whole matrix. commit() swaps the
+    new files in atomically.
+    """
+
+    def __init__(self, store: 'GalleryStore', dtype: np.dtype):
+        self._store = store
+        self._dtype = np.dtype(dtype)
+        self._dim: Optional[int] = None
+        self._user_ids: List[str] = []
+        self._names: List[str] = []
+        # Unique per writer: concurrent rebuilds, even in one process, must
+        # not stream into the same file
+        self._file, self._tmp_bin = _open_temp_beside(store.bin_path)
+
+    def append(self, user_ids: List[str], names: List[str], block: np.ndarray) -> None:
+        """Append one (n, D) block of rows"""
+        if self._dim is None:
+            self._dim = block.shape[1]
+        self._file.write(np.ascontiguousarray(block, dtype=self._dtype).tobytes())
+        self._user_ids.extend(user_ids)
+        self._names.extend(names)
+
+    def commit(self) -> None:
+        """Publish the new gallery (bin first, then the index that describes it)"""
+        self._file.close()
+        index = {
+            'dim': self._dim or 0,
+            'dtype': self._dtype.str,
+            'user_ids': self._user_ids,
+            'names': self._names
+        }
+        with self._store.locked():
+            os.replace(self._tmp_bin, self._store.bin_path)
+            self._store.write_index(index)
+
+    def abort(self) -> None:
+        """Discard the partial rebuild"""
+        self._file.close()
+        if os.path.exists(self._tmp_bin):
+            os.remove(self._tmp_bin)
+
+
+class GalleryStore:
+    """
+    Flat-file (N, D) embedding gallery shared through numpy.memmap
+
+    The database stays the source of truth; the store is a rebuildable
+    cache that Database.load_embedding_matrix() fills and reads.
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.bin_path = os.path.join(directory, 'gallery.bin')
+        self.index_path = os.path.join(directory, 'gallery_index.json')
+        self._lock_path = os.path.join(directory, 'gallery.lock')
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        """Exclusive inter-process lock for writers"""
+        with open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_index(self) -> Optional[dict]:
+        try:
+            with open(self.index_path, 'rb') as f:
+                return orjson.loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def write_index(self, index: dict) -> None:
+        """Atomically replace the index file"""
+        f, tmp = _open_temp_beside(self.index_path)
+        with f:
+            f.write(orjson.dumps(index))
+        os.replace(tmp, self.index_path)
+
+    def age(self) -> float:
+        """Seconds since the gallery was last written (inf if missing)"""
+        try:
+            return time.time() - os.path.getmtime(self.index_path)
+        except OSError:
+            return float('inf')
+
+    def load(self) -> Optional[Tuple[List[str], List[str], np.ndarray]]:
+        """
+        Memory-map the current gallery
+
+        Returns:
+            Tuple of (user_ids, names, read-only (N, D) memmap), or None if
+            the store is missing, empty or inconsistent
+        """
+        index = self._read_index()
+        if not index or not index['user_ids'] or not index['dim']:
+            return None
+
+        dtype = np.dtype(index['dtype'])
+        shape = (len(index['user_ids']), index['dim'])
+        try:
+            if os.path.getsize(self.bin_path) < shape[0] * shape[1] * dtype.itemsize:
+                # Index describes rows that are not on disk (torn write)
+                return None
+            matrix = np.memmap(self.bin_path, dtype=dtype, mode='r', shape=shape)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to map gallery file: {e}")
+            return None
+
+        return index['user_ids'], index['names'], matrix
+
+    def writer(self, dtype: np.dtype) -> GalleryWriter:
+        """Start a full rebuild"""
+        return GalleryWriter(self, dtype)
+
+    def upsert(self, user_id: str, name: str, embedding: np.ndarray) -> bool:
+        """
+        Add or replace one enrolled embedding in place
+
+        An existing row is overwritten through a writable memmap; a new
+        user is appended to the end of gallery.bin.
+
+        Args:
+            user_id: User identifier
+            name: User's name
+            embedding: Row in the gallery's dtype and dimension
+
+        Returns:
+            True if the gallery was updated, False if it has to be rebuilt
+            (missing, or embedding shape/dtype differs)
+        """
+        with self.locked():
+            index = self._read_index()
+            if not index or not index['dim']:
+                return False
+
+            dtype = np.dtype(index['dtype'])
+            row = np.ascontiguousarray(embedding, dtype=dtype)
+            if row.shape != (index['dim'],) or embedding.dtype != dtype:
+                return False
+
+            user_ids = index['user_ids']
+            try:
+                i = user_ids.index(user_id)
+            except ValueError:
+                i = -1
+
+            if i >= 0:
+                matrix = np.memmap(self.bin_path, dtype=dtype, mode='r+', shape=(len(user_ids), index['dim']))
+                matrix[i] = row
+                matrix.flush()
+                index['names'][i] = name
+            else:
+                with open(self.bin_path, 'ab') as f:
+                    f.write(row.tobytes())
+                user_ids.append(user_id)
+                index['names'].append(name)
+
+            self.write_index(index)
+            return True
@@ -7,18 +7,27 @@ This backend handles:
 - Face recognition (comparing against stored embeddings)
 - Attendance marking with business rules
 """
-from fastapi import FastAPI, HTTPException, Header, status
+from fastapi import FastAPI, HTTPException, Header, Depends, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
+import asyncio
+import hmac
 import logging
-import base64
 import cv2
 import numpy as np
-import json
-from typing import Optional
+from typing import Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import uvicorn
 
-from config import get_settings
+try:
+    # SIMD (AVX2/NEON) base64 decoder with the stdlib's API
+    import pybase64 as base64
+except ImportError:
+    # Falls back to the stdlib decoder
+    import base64
+
+from config import get_settings, onnx_thread_count
 from models import (
     EnrollRequest,
     RecognizeRequest,
@@ -26,8 +35,10 @@ from models import (
     RecognizeResponse,
     HealthResponse
 )
-from face_recognition_engine import face_engine
-from database import database
+from face_recognition_engine import FaceRecognitionEngine, get_face_engine
+from database import Database, get_database
+from embedding_batcher import EmbeddingBatcher
+from embedding_cache import EmbeddingCache
 
 # Configure logging
 logging.basicConfig(
@@ -39,11 +50,29 @@ logger = logging.getLogger(__name__)
 # Load settings
 settings = get_settings()
 
+# Expected API key as bytes for hmac.compare_digest (None = auth disabled)
+_API_KEY_BYTES = settings.api_key.encode() if settings.api_key else None
+
+# Embeddings of recently seen images, keyed by content hash
+embedding_cache = EmbeddingCache(max_size=settings.embedding_lru_size)
+
+
+@lru_cache(maxsize=1)
+def get_embedding_batcher() -> EmbeddingBatcher:
+    """Concurrent embedding requests are coalesced into one inference call"""
+    return EmbeddingBatcher(
+        get_face_engine(),
+        window_ms=settings.batch_window_ms,
+        max_batch_size=settings.max_batch_size
+    )
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Face Recognition Attendance API",
     description="Production-ready face recognition backend for attendance system",
-    version="1.0.0"
+    version="1.0.0",
+    # orjson serializes responses several times faster than stdlib json
+    default_response_class=ORJSONResponse
 )
 
 # CORS middleware for Android app
@@ -70,14 +99,27 @@ async def startup_event():
     logger.info("Starting Face Recognition Attendance API")
     logger.info("=" * 60)
     
-    # Check if face recognition model is loaded
+    # Bounded pool behind asyncio.to_thread(): image decode, face detection
+    # and sync DB calls run off the event loop. Twice this worker's cores so
+    # Supabase round trips overlap CPU work without oversubscribing the VM
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=max(4, 2 * onnx_thread_count()), thread_name_prefix="pipeline")
+    )
+    
+    # Load the face recognition model (first use of the shared engine)
+    face_engine = get_face_engine()
     if face_engine.is_model_loaded():
         logger.info("✓ Face recognition engine initialized")
     else:
         logger.warning("⚠ Face recognition engine using fallback mode")
     
-    # Test database connection
-    if database.test_connection():
+    # Push a synthetic image through detection and inference so the first
+    # request doesn't pay for buffer allocation and kernel compilation
+    await asyncio.to_thread(face_engine.warmup)
+    
+    # Open the async direct Postgres pool (if configured) and test the connection
+    await get_database().open_pool()
+    if await asyncio.to_thread(get_database().test_connection):
         logger.info("✓ Database connection established")
     else:
         logger.error("✗ Database connection failed")
@@ -91,6 +133,10 @@ async def startup_event():
 async def shutdown_event():
     """Cleanup on shutdown"""
     logger.info("Shutting down Face Recognition Attendance API")
+    # The batcher is created on first use; don't build one just to stop it
+    if get_embedding_batcher.cache_info().currsize:
+        get_embedding_batcher().shutdown()
+    await get_database().close_pool()
 
 
 # ============================================================================
@@ -107,13 +153,89 @@ def verify_api_key(x_api_key: Optional[str] = Header(None)):
     Raises:
         HTTPException: If API key is invalid
     """
-    if settings.api_key and x_api_key != settings.api_key:
+    if _API_KEY_BYTES is None:
+        return
+    
+    # Constant-time comparison, so response timing doesn't leak the key
+    if not x_api_key or not hmac.compare_digest(x_api_key.encode(), _API_KEY_BYTES):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid API key"
         )
 
 
+# JPEG start-of-frame markers (baseline, progressive, lossless, ...); C4, C8
+# and CC share the range but are DHT, JPG and DAC segments
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# DCT-domain downscale factors cv2.imdecode can apply while decoding
+_REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def _jpeg_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Read (height, width) from a JPEG's start-of-frame header
+    
+    Walks the marker segments up to SOFn without decoding anything.
+    
+    Returns:
+        (height, width), or None if data is not a JPEG or has no SOF
+        before the scan data
+    """
+    if data[:2] != b'\xff\xd8':
+        return None
+    
+    i, n = 2, len(data)
+    while i + 4 <= n:
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # Standalone markers carry no length
+            i += 2
+            continue
+        if marker == 0xDA:
+            # Start of scan - no frame header before the image data
+            return None
+        
+        length = (data[i + 2] << 8) | data[i + 3]
+        if marker in _JPEG_SOF_MARKERS:
+            if i + 9 > n:
+                return None
+            height = (data[i + 5] << 8) | data[i + 6]
+            width = (data[i + 7] << 8) | data[i + 8]
+            return height, width
+        i += 2 + length
+    return None
+
+
+def _imdecode_flag(image_bytes: bytes) -> int:
+    """
+    Largest JPEG decode-time reduction that keeps the longest side at
+    least MAX_IMAGE_DIM (IMREAD_COLOR for other formats or small images)
+    """
+    if settings.max_image_dim <= 0:
+        return cv2.IMREAD_COLOR
+    
+    dims = _jpeg_dimensions(image_bytes)
+    if dims is None:
+        return cv2.IMREAD_COLOR
+    
+    max_dim = max(dims)
+    for factor, flag in _REDUCED_DECODE_FLAGS:
+        if max_dim // factor >= settings.max_image_dim:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
 def decode_base64_image(base64_string: str) -> Optional[np.ndarray]:
     """
     Decode base64 string to OpenCV image
@@ -122,26 +244,38 @@ def decode_base64_image(base64_string: str) -> Optional[np.ndarray]:
         base64_string: Base64 encoded image
         
     Returns:
-        OpenCV image (BGR format) or None if failed
+        OpenCV image (BGR format, longest side at most MAX_IMAGE_DIM) or
+        None if failed
     """
     try:
-        # Remove data URL prefix if present
-        if ',' in base64_string:
-            base64_string = base64_string.split(',')[1]
+        # One ASCII copy of the payload; the data URL prefix (if present) is
+        # skipped through a memoryview instead of copying the string again
+        data = base64_string.encode('ascii')
+        comma = data.find(b',')
         
         # Decode base64
-        image_bytes = base64.b64decode(base64_string)
+        image_bytes = base64.b64decode(memoryview(data)[comma + 1:])
         
-        # Convert to numpy array
+        # Zero-copy view of the decoded bytes
         nparr = np.frombuffer(image_bytes, np.uint8)
         
-        # Decode image
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        # Decode image - large JPEGs are scaled down by 2/4/8 inside the
+        # decoder, skipping most of the IDCT work for full-size phone photos
+        image = cv2.imdecode(nparr, _imdecode_flag(image_bytes))
         
         if image is None:
             logger.error("Failed to decode image")
             return None
         
+        # Phone cameras send 12 MP frames; detection and the 112x112 crop
+        # gain nothing above MAX_IMAGE_DIM, so the full-size array is
+        # dropped here instead of being carried through the pipeline
+        height, width = image.shape[:2]
+        max_dim = max(height, width)
+        if 0 < settings.max_image_dim < max_dim:
+            scale = settings.max_image_dim / max_dim
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        
         return image
         
     except Exception as e:
@@ -164,13 +298,16 @@ async def root():
 
 
 @app.get("/health", response_model=HealthResponse, tags=["Health"])
-async def health_check():
+async def health_check(
+    database: Database = Depends(get_database),
+    face_engine: FaceRecognitionEngine = Depends(get_face_engine)
+):
     """
     Health check endpoint
     Returns status of model and database connection
     """
     model_loaded = face_engine.is_model_loaded()
-    db_connected = database.test_connection()
+    db_connected = await asyncio.to_thread(database.test_connection)
     
     return HealthResponse(
         status="healthy" if (model_loaded and db_connected) else "degraded",
@@ -182,7 +319,9 @@ async def health_check():
 @app.post("/enroll", response_model=EnrollResponse, tags=["Face Recognition"])
 async def enroll_face(
     request: EnrollRequest,
-    x_api_key: Optional[str] = Header(None)
+    x_api_key: Optional[str] = Header(None),
+    database: Database = Depends(get_database),
+    face_engine: FaceRecognitionEngine = Depends(get_face_engine)
 ):
     """
     Enroll a new face
@@ -196,6 +335,8 @@ async def enroll_face(
     Args:
         request: Enrollment request with user_id, name, and base64 image
         x_api_key: API key for authentication
+        database: Shared Database instance (injected)
+        face_engine: Shared FaceRecognitionEngine instance (injected)
         
     Returns:
         EnrollResponse with success status and message
@@ -206,32 +347,40 @@ async def enroll_face(
     logger.info(f"Enrollment request for user: {request.user_id}")
     
     try:
-        # Decode image
-        image = decode_base64_image(request.image)
-        if image is None:
-            return EnrollResponse(
-                success=False,
-                message="Failed to decode image"
-            )
-        
-        # Detect and align face
-        face = face_engine.detect_and_align_face(image)
-        if face is None:
-            return EnrollResponse(
-                success=False,
-                message="No face detected in image. Please ensure face is clearly visible."
-            )
-        
-        # Extract embedding
-        embedding = face_engine.extract_embedding(face)
+        # Identical images (retried or resubmitted frames) skip decode,
+        # detection and inference
+        cache_key = embedding_cache.key(request.image)
+        embedding = embedding_cache.get(cache_key)
         if embedding is None:
-            return EnrollResponse(
-                success=False,
-                message="Failed to extract face features"
-            )
+            # Decode image
+            image = await asyncio.to_thread(decode_base64_image, request.image)
+            if image is None:
+                return EnrollResponse(
+                    success=False,
+                    message="Failed to decode image"
+                )
+            
+            # Detect and align face
+            face = await asyncio.to_thread(face_engine.detect_and_align_face, image)
+            if face is None:
+                return EnrollResponse(
+                    success=False,
+                    message="No face detected in image. Please ensure face is clearly visible."
+                )
+            
+            # Extract embedding
+            embedding = await get_embedding_batcher().embed(face)
+            if embedding is None:
+                return EnrollResponse(
+                    success=False,
+                    message="Failed to extract face features"
+                )
+            
+            embedding_cache.put(cache_key, embedding)
         
         # Store in database (only embedding, NOT raw image)
-        success = database.store_face_embedding(
+        success = await asyncio.to_thread(
+            database.store_face_embedding,
             user_id=request.user_id,
             name=request.name,
             embedding=embedding
@@ -261,7 +410,9 @@ async def enroll_face(
 @app.post("/recognize", response_model=RecognizeResponse, tags=["Face Recognition"])
 async def recognize_face(
     request: RecognizeRequest,
-    x_api_key: Optional[str] = Header(None)
+    x_api_key: Optional[str] = Header(None),
+    database: Database = Depends(get_database),
+    face_engine: FaceRecognitionEngine = Depends(get_face_engine)
 ):
     """
     Recognize face and mark attendance
@@ -282,6 +433,8 @@ async def recognize_face(
     Args:
         request: Recognition request with user_id and base64 image
         x_api_key: API key for authentication
+        database: Shared Database instance (injected)
+        face_engine: Shared FaceRecognitionEngine instance (injected)
         
     Returns:
         RecognizeResponse with match status and attendance info
@@ -292,40 +445,52 @@ async def recognize_face(
     logger.info(f"Recognition request for user: {request.user_id}")
     
     try:
-        # Decode image
-        image = decode_base64_image(request.image)
-        if image is None:
-            return RecognizeResponse(
-                matched=False,
-                message="Failed to decode image"
-            )
-        
-        # Detect and align face
-        face = face_engine.detect_and_align_face(image)
-        if face is None:
-            return RecognizeResponse(
-                matched=False,
-                message="No face detected. Please ensure face is clearly visible."
-            )
-        
-        # Extract embedding
-        current_embedding = face_engine.extract_embedding(face)
+        # Identical images (retried or resubmitted frames) skip decode,
+        # detection and inference
+        cache_key = embedding_cache.key(request.image)
+        current_embedding = embedding_cache.get(cache_key)
         if current_embedding is None:
-            return RecognizeResponse(
-                matched=False,
-                message="Failed to extract face features"
-            )
+            # Decode image
+            image = await asyncio.to_thread(decode_base64_image, request.image)
+            if image is None:
+                return RecognizeResponse(
+                    matched=False,
+                    message="Failed to decode image"
+                )
+            
+            # Detect and align face
+            face = await asyncio.to_thread(face_engine.detect_and_align_face, image)
+            if face is None:
+                return RecognizeResponse(
+                    matched=False,
+                    message="No face detected. Please ensure face is clearly visible."
+                )
+            
+            # Extract embedding
+            current_embedding = await get_embedding_batcher().embed(face)
+            if current_embedding is None:
+                return RecognizeResponse(
+                    matched=False,
+                    message="Failed to extract face features"
+                )
+            
+            embedding_cache.put(cache_key, current_embedding)
         
-        # Get stored embedding from database
-        stored_embedding = database.get_face_embedding(request.user_id)
-        if stored_embedding is None:
+        # Get stored embedding and name from database (one round trip)
+        stored = await asyncio.to_thread(database.get_face_embedding, request.user_id)
+        if stored is None:
             return RecognizeResponse(
                 matched=False,
                 message=f"User {request.user_id} not enrolled. Please enroll first."
             )
+        stored_embedding, user_name = stored
+        # Fall back to user_id if the row has no name
+        user_name = user_name or request.user_id
         
         # Compare embeddings
-        confidence = face_engine.compare_embeddings(current_embedding, stored_embedding)
+        confidence = await asyncio.to_thread(
+            face_engine.compare_embeddings, current_embedding, stored_embedding
+        )
         logger.info(f"Recognition confidence for {request.user_id}: {confidence:.3f}")
         
         # Check if confidence meets threshold
@@ -336,10 +501,16 @@ async def recognize_face(
                 message=f"Face does not match. Confidence: {confidence:.2f}"
             )
         
-        # Face matched! Check attendance rules
-        attendance_count = database.get_attendance_count_today(request.user_id)
+        # Face matched! Insert attendance unless today's limit is reached
+        # (count and insert are one atomic DB call)
+        attendance_id, attendance_count = await database.try_mark_attendance(
+            user_id=request.user_id,
+            name=user_name,
+            confidence=confidence,
+            max_per_day=settings.max_attendance_per_day
+        )
         
-        if attendance_count >= settings.max_attendance_per_day:
+        if attendance_id is None and attendance_count >= settings.max_attendance_per_day:
             return RecognizeResponse(
                 matched=True,
                 confidence=confidence,
@@ -347,23 +518,6 @@ async def recognize_face(
                 attendance_count_today=attendance_count
             )
         
-        # Get user name (fallback to user_id if database query fails)
-        user_name = request.user_id
-        try:
-            if database._client is not None:
-                user_info = database._client.table('face_embeddings').select('name').eq('user_id', request.user_id).execute()
-                if user_info.data:
-                    user_name = user_info.data[0]['name']
-        except Exception as e:
-            logger.warning(f"Could not retrieve user name for {request.user_id}: {e}")
-        
-        # Insert attendance record
-        attendance_id = database.insert_attendance(
-            user_id=request.user_id,
-            name=user_name,
-            confidence=confidence
-        )
-        
         if attendance_id:
             logger.info(f"Attendance marked for {request.user_id}, ID: {attendance_id}")
             return RecognizeResponse(
@@ -391,7 +545,9 @@ async def recognize_face(
 @app.post("/identify", tags=["Face Recognition"])
 async def identify_face(
     request: RecognizeRequest,
-    x_api_key: Optional[str] = Header(None)
+    x_api_key: Optional[str] = Header(None),
+    database: Database = Depends(get_database),
+    face_engine: FaceRecognitionEngine = Depends(get_face_engine)
 ):
     """
     Identify an unknown face by comparing against all stored faces
@@ -402,6 +558,8 @@ async def identify_face(
     Args:
         request: RecognizeRequest with image (user_id is ignored)
         x_api_key: API key for authentication
+        database: Shared Database instance (injected)
+        face_engine: Shared FaceRecognitionEngine instance (injected)
         
     Returns:
         JSON with identified user info or no match found
@@ -412,62 +570,85 @@ async def identify_face(
     logger.info("Identification request (searching all faces)")
     
     try:
-        # Decode image
-        image = decode_base64_image(request.image)
-        if image is None:
-            return JSONResponse(
-                content={"identified": False, "message": "Failed to decode image"},
-                status_code=400
-            )
-        
-        # Detect and align face
-        face = face_engine.detect_and_align_face(image)
-        if face is None:
-            return JSONResponse(
-                content={"identified": False, "message": "No face detected"},
-                status_code=200
-            )
-        
-        # Extract embedding
-        current_embedding = face_engine.extract_embedding(face)
+        # Identical images (retried or resubmitted frames) skip decode,
+        # detection and inference
+        cache_key = embedding_cache.key(request.image)
+        current_embedding = embedding_cache.get(cache_key)
         if current_embedding is None:
-            return JSONResponse(
-                content={"identified": False, "message": "Failed to extract face features"},
-                status_code=200
-            )
-        
-        # Get all stored faces
-        all_faces = database.get_all_face_embeddings()
-        if not all_faces:
-            return JSONResponse(
-                content={"identified": False, "message": "No faces enrolled yet"},
-                status_code=200
-            )
+            # Decode image
+            image = await asyncio.to_thread(decode_base64_image, request.image)
+            if image is None:
+                return ORJSONResponse(
+                    content={"identified": False, "message": "Failed to decode image"},
+                    status_code=400
+                )
+            
+            # Detect and align face
+            face = await asyncio.to_thread(face_engine.detect_and_align_face, image)
+            if face is None:
+                return ORJSONResponse(
+                    content={"identified": False, "message": "No face detected"},
+                    status_code=200
+                )
+            
+            # Extract embedding
+            current_embedding = await get_embedding_batcher().embed(face)
+            if current_embedding is None:
+                return ORJSONResponse(
+                    content={"identified": False, "message": "Failed to extract face features"},
+                    status_code=200
+                )
+            
+            embedding_cache.put(cache_key, current_embedding)
         
-        # Find best match
-        best_match = None
-        best_confidence = 0.0
+        # Prefer server-side pgvector KNN; None means it is not configured
+        candidates = await database.nearest(current_embedding, k=1)
         
-        for face_data in all_faces:
-            stored_embedding = np.array(json.loads(face_data['embedding']))
-            confidence = face_engine.compare_embeddings(current_embedding, stored_embedding)
+        if candidates is None:
+            # Get cached (N, D) matrix of L2-normalized stored embeddings
+            user_ids, names, embedding_matrix = await database.load_embedding_matrix()
+            
+            if not user_ids:
+                return ORJSONResponse(
+                    content={"identified": False, "message": "No faces enrolled yet"},
+                    status_code=200
+                )
+            
+            # Score the whole gallery with a single matrix-vector product
+            # (FAISS HNSW search for large galleries, if installed). Off the
+            # event loop: a large scan, or the first index build, takes a while
+            best, best_confidence = await asyncio.to_thread(
+                face_engine.match,
+                current_embedding, embedding_matrix, settings.confidence_threshold,
+                ann_min_rows=settings.ann_min_gallery_size
+            )
+            user_id, name = (user_ids[best], names[best]) if best >= 0 else (None, None)
+        else:
+            if not candidates:
+                return ORJSONResponse(
+                    content={"identified": False, "message": "No faces enrolled yet"},
+                    status_code=200
+                )
             
-            if confidence > best_confidence:
-                best_confidence = confidence
-                best_match = face_data
+            user_id, name, similarity = candidates[0]
+            
+            # Map cosine similarity [-1, 1] to confidence [0, 1] (same as compare_embeddings)
+            best_confidence = (min(max(similarity, -1.0), 1.0) + 1.0) * 0.5
         
         # Check if best match meets threshold
-        if best_match and best_confidence >= settings.confidence_threshold:
-            user_id = best_match['user_id']
-            name = best_match['name']
-            
+        if best_confidence >= settings.confidence_threshold:
             logger.info(f"Identified as {name} ({user_id}) with confidence {best_confidence:.3f}")
             
-            # Check attendance rules
-            attendance_count = database.get_attendance_count_today(user_id)
+            # Mark attendance unless today's limit is reached (one atomic DB call)
+            attendance_id, attendance_count = await database.try_mark_attendance(
+                user_id=user_id,
+                name=name,
+                confidence=best_confidence,
+                max_per_day=settings.max_attendance_per_day
+            )
             
-            if attendance_count >= settings.max_attendance_per_day:
-                return JSONResponse(content={
+            if attendance_id is None and attendance_count >= settings.max_attendance_per_day:
+                return ORJSONResponse(content={
                     "identified": True,
                     "employee_id": user_id,
                     "name": name,
@@ -476,14 +657,7 @@ async def identify_face(
                     "message": f"Already marked {attendance_count} times today"
                 })
             
-            # Mark attendance
-            attendance_id = database.insert_attendance(
-                user_id=user_id,
-                name=name,
-                confidence=best_confidence
-            )
-            
-            return JSONResponse(content={
+            return ORJSONResponse(content={
                 "identified": True,
                 "employee_id": user_id,
                 "name": name,
@@ -494,7 +668,7 @@ async def identify_face(
             })
         else:
             logger.info(f"No match found. Best confidence: {best_confidence:.3f}")
-            return JSONResponse(content={
+            return ORJSONResponse(content={
                 "identified": False,
                 "message": "No matching face found",
                 "best_confidence": float(best_confidence)
@@ -513,10 +687,25 @@ async def identify_face(
 # ============================================================================
 
 if __name__ == "__main__":
+    try:
+        # libuv event loop; there is no Windows build, where asyncio is used
+        import uvloop  # noqa: F401
+        loop = "uvloop"
+    except ImportError:
+        loop = "asyncio"
+    try:
+        # C HTTP/1.1 parser; falls back to the pure-Python h11
+        import httptools  # noqa: F401
+        http = "httptools"
+    except ImportError:
+        http = "h11"
+    
     uvicorn.run(
         "main:app",
         host=settings.host,
         port=settings.port,
         workers=settings.workers,
+        loop=loop,
+        http=http,
         log_level="info"
     )
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+uint8-Input Model Script
+Bakes the input preprocessing into a copy of the face embedding model
+
+Prepends Cast(uint8 -> float32) -> Mul(1/127.5) -> Sub(1.0) ->
+Transpose(NHWC -> NCHW) to the graph, so the backend feeds the resized
+RGB face straight in. Run once offline; the backend loads
+models/face_embedding_u8in.onnx instead of the other models when it exists.
+"""
+import os
+import sys
+import traceback
+
+# Full tracebacks only when debugging (same DEBUG variable as the backend .env)
+DEBUG = os.environ.get('DEBUG', '').lower() in ('1', 'true', 'yes')
+
+MODEL_PATH = 'models/face_embedding.onnx'
+INT8_MODEL_PATH = 'models/face_embedding_int8.onnx'
+U8IN_MODEL_PATH = 'models/face_embedding_u8in.onnx'
+
+def add_uint8_input(model_path, output_path):
+    """Replace the float32 NCHW input with a uint8 NHWC input plus normalization nodes"""
+    try:
+        import numpy as np
+        import onnx
+        from onnx import helper, numpy_helper, TensorProto
+
+        print(f"Rewriting {model_path} -> {output_path} ...")
+        model = onnx.load(model_path)
+        graph = model.graph
+
+        initializer_names = {init.name for init in graph.initializer}
+        inputs = [i for i in graph.input if i.name not in initializer_names]
+        if len(inputs) != 1:
+            print(f"✗ Expected one model input, found {len(inputs)}")
+            return False
+        old_input = inputs[0]
+        if old_input.type.tensor_type.elem_type != TensorProto.FLOAT:
+            print("✗ Model input is not float32 (already rewritten?)")
+            return False
+
+        dims = old_input.type.tensor_type.shape.dim
+        if len(dims) != 4:
+            print(f"✗ Expected a 4-D NCHW input, found {len(dims)} dims")
+            return False
+
+        def dim_value(d):
+            return d.dim_param if d.HasField('dim_param') else d.dim_value
+
+        n, c, h, w = (dim_value(d) for d in dims)
+        name = old_input.name
+        u8_name = f"{name}_uint8"
+
+        # Original input name becomes the output of the new prefix, so the
+        # rest of the graph is untouched
+        new_input = helper.make_tensor_value_info(u8_name, TensorProto.UINT8, [n, h, w, c])
+        graph.input.remove(old_input)
+        graph.input.insert(0, new_input)
+
+        graph.initializer.extend([
+            numpy_helper.from_array(np.array(1.0 / 127.5, dtype=np.float32), f"{name}_scale"),
+            numpy_helper.from_array(np.array(1.0, dtype=np.float32), f"{name}_offset"),
+        ])
+        prefix = [
+            helper.make_node('Cast', [u8_name], [f"{name}_f32"], to=TensorProto.FLOAT),
+            helper.make_node('Mul', [f"{name}_f32", f"{name}_scale"], [f"{name}_scaled"]),
+            helper.make_node('Sub', [f"{name}_scaled", f"{name}_offset"], [f"{name}_nhwc"]),
+            helper.make_node('Transpose', [f"{name}_nhwc"], [name], perm=[0, 3, 1, 2]),
+        ]
+        for node in reversed(prefix):
+            graph.node.insert(0, node)
+
+        onnx.checker.check_model(model)
+        onnx.save(model, output_path)
+        print("✓ uint8-input model written")
+        return True
+    except ImportError:
+        print("⚠ Graph rewriting needs the ONNX library. Install with: pip install onnx")
+        return False
+    except Exception as e:
+        print(f"✗ Rewrite failed: {e}")
+        if DEBUG:
+            traceback.print_exc()
+        return False
+
+def compare_outputs(model_path, output_path):
+    """Run both models on the same random face and report embedding agreement"""
+    try:
+        import numpy as np
+        import onnxruntime as ort
+
+        float_session = ort.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+        u8_session = ort.InferenceSession(output_path, providers=['CPUExecutionProvider'])
+
+        inp = u8_session.get_inputs()[0]
+        shape = [d if isinstance(d, int) and d > 0 else 1 for d in inp.shape]
+        face = np.random.randint(0, 256, shape, dtype=np.uint8)
+        # Same normalization the backend applies for float32 models
+        normalized = (face.transpose(0, 3, 1, 2).astype(np.float32) / 127.5) - 1.0
+
+        a = float_session.run(None, {float_session.get_inputs()[0].name: normalized})[0].flatten()
+        b = u8_session.run(None, {inp.name: face})[0].flatten()
+        similarity = float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+        print(f"\nCosine similarity float vs uint8-input embedding: {similarity:.6f}")
+        if similarity < 0.9999:
+            print("⚠ Embeddings differ - check the model's expected normalization")
+        return True
+    except Exception as e:
+        print(f"✗ Comparison failed: {e}")
+        if DEBUG:
+            traceback.print_exc()
+        return False
+
+def main():
+    print("=" * 60)
+    print("uint8-Input Model (baked-in preprocessing)")
+    print("=" * 60)
+
+    # Rewrite the model the backend would otherwise load
+    source_path = INT8_MODEL_PATH if os.path.exists(INT8_MODEL_PATH) else MODEL_PATH
+    if not os.path.exists(source_path):
+        print(f"✗ Model file not found: {source_path}")
+        return False
+
+    if not add_uint8_input(source_path, U8IN_MODEL_PATH):
+        return False
+
+    ok = compare_outputs(source_path, U8IN_MODEL_PATH)
+
+    print("\n" + "=" * 60)
+    if ok:
+        print(f"✓ Done. Restart the backend to load {U8IN_MODEL_PATH}")
+        print(f"  Delete it to go back to {source_path}")
+    return ok
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
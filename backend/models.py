@@ -3,7 +3,20 @@ Pydantic models for request/response validation
 """
 from pydantic import BaseModel, Field, validator
 from typing import Optional
-import base64
+
+
+def _check_base64_image(v: str) -> str:
+    """
+    Cheap structural check of a base64 image string
+    
+    The payload is decoded exactly once, by the endpoint; a full decode here
+    as well would double the base64 CPU and transient memory per request.
+    Malformed base64 that passes this check fails that decode instead.
+    """
+    # Non-empty payload after the optional data URL prefix, ASCII only
+    if not v.isascii() or len(v) - v.find(',') <= 1:
+        raise ValueError("Invalid base64 encoded image")
+    return v
 
 
 class EnrollRequest(BaseModel):
@@ -15,12 +28,7 @@ class EnrollRequest(BaseModel):
     @validator('image')
     def validate_base64(cls, v):
         """Validate base64 image string"""
-        try:
-            # Try to decode to verify it's valid base64
-            base64.b64decode(v)
-            return v
-        except Exception:
-            raise ValueError("Invalid base64 encoded image")
+        return _check_base64_image(v)
     
     @validator('user_id')
     def validate_user_id(cls, v):
@@ -38,11 +46,7 @@ class RecognizeRequest(BaseModel):
     @validator('image')
     def validate_base64(cls, v):
         """Validate base64 image string"""
-        try:
-            base64.b64decode(v)
-            return v
-        except Exception:
-            raise ValueError("Invalid base64 encoded image")
+        return _check_base64_image(v)
     
     @validator('user_id')
     def validate_user_id(cls, v):
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+ONNX Model Quantization Script
+Writes an INT8 (dynamic quantization) copy of the face embedding model
+
+Run once offline; the backend loads models/face_embedding_int8.onnx
+instead of the fp32 model when it exists.
+"""
+import os
+import sys
+import traceback
+
+# Full tracebacks only when debugging (same DEBUG variable as the backend .env)
+DEBUG = os.environ.get('DEBUG', '').lower() in ('1', 'true', 'yes')
+
+MODEL_PATH = 'models/face_embedding.onnx'
+INT8_MODEL_PATH = 'models/face_embedding_int8.onnx'
+
+def quantize(model_path, output_path):
+    """Quantize weights to INT8; activations are quantized dynamically at runtime"""
+    try:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        
+        print(f"Quantizing {model_path} -> {output_path} ...")
+        # QUInt8 weights: the CPU provider's ConvInteger kernel has no int8-weight
+        # implementation, so QInt8 would produce a model that fails to load
+        quantize_dynamic(model_path, output_path, weight_type=QuantType.QUInt8)
+        print("✓ Quantized model written")
+        return True
+    except ImportError:
+        print("⚠ ONNX Runtime quantization tools need the ONNX library. Install with: pip install onnx")
+        return False
+    except Exception as e:
+        print(f"✗ Quantization failed: {e}")
+        if DEBUG:
+            traceback.print_exc()
+        return False
+
+def compare_outputs(model_path, output_path):
+    """Run both models on the same random input and report embedding agreement"""
+    try:
+        import numpy as np
+        import onnxruntime as ort
+        
+        fp32 = ort.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+        int8 = ort.InferenceSession(output_path, providers=['CPUExecutionProvider'])
+        
+        inp = fp32.get_inputs()[0]
+        shape = [d if isinstance(d, int) and d > 0 else 1 for d in inp.shape]
+        data = np.random.uniform(-1.0, 1.0, shape).astype(np.float32)
+        
+        a = fp32.run(None, {inp.name: data})[0].flatten()
+        b = int8.run(None, {inp.name: data})[0].flatten()
+        similarity = float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+        
+        print(f"\nCosine similarity fp32 vs int8 embedding: {similarity:.4f}")
+        if similarity < 0.99:
+            print("⚠ Low agreement - validate recognition accuracy before deploying")
+        return True
+    except Exception as e:
+        print(f"✗ Comparison failed: {e}")
+        if DEBUG:
+            traceback.print_exc()
+        return False
+
+def main():
+    print("=" * 60)
+    print("ONNX Model Quantization (INT8)")
+    print("=" * 60)
+    
+    if not os.path.exists(MODEL_PATH):
+        print(f"✗ Model file not found: {MODEL_PATH}")
+        return False
+    
+    if not quantize(MODEL_PATH, INT8_MODEL_PATH):
+        return False
+    
+    fp32_size = os.path.getsize(MODEL_PATH) / (1024 * 1024)
+    int8_size = os.path.getsize(INT8_MODEL_PATH) / (1024 * 1024)
+    print(f"  Size: {fp32_size:.2f} MB -> {int8_size:.2f} MB")
+    
+    ok = compare_outputs(MODEL_PATH, INT8_MODEL_PATH)
+    
+    print("\n" + "=" * 60)
+    if ok:
+        print(f"✓ Done. Restart the backend to load {INT8_MODEL_PATH}")
+        print("  Delete it to go back to the fp32 model")
+    return ok
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
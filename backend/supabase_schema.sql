@@ -8,14 +8,16 @@ CREATE EXTENSION IF NOT EXISTS vector;
 
 -- Table: face_embeddings
 -- Stores face embeddings (NOT raw images) for each user
--- Note: Current code stores embeddings as JSON TEXT for compatibility
--- For optimal performance with pgvector, consider migrating to vector type
+-- Embeddings are stored as int8 bytes (BYTEA) with a per-vector scale:
+-- value[i] = embedding[i] * embedding_scale. Rows with a NULL scale hold
+-- raw little-endian float32 bytes.
 CREATE TABLE IF NOT EXISTS face_embeddings (
     id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
     user_id VARCHAR(100) UNIQUE NOT NULL,
     name VARCHAR(255) NOT NULL,
-    embedding TEXT NOT NULL, -- JSON array of floats (compatible with current code)
-    -- Future: embedding vector(512) -- Use pgvector for similarity search
+    embedding BYTEA NOT NULL, -- int8 bytes (embedding_dim), or float32 if scale is NULL
+    embedding_scale REAL, -- Dequantization scale for int8 embeddings
+    emb vector(512), -- Optional pgvector copy for KNN (PGVECTOR_ENABLED=true); N = PGVECTOR_DIM = model dim
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
@@ -23,8 +25,8 @@ CREATE TABLE IF NOT EXISTS face_embeddings (
 -- Index for fast user_id lookups
 CREATE INDEX IF NOT EXISTS idx_face_embeddings_user_id ON face_embeddings(user_id);
 
--- Note: If migrating to pgvector vector type, add this index:
--- CREATE INDEX ON face_embeddings USING ivfflat (embedding vector_cosine_ops);
+-- HNSW index for server-side cosine KNN (used by /identify when PGVECTOR_ENABLED=true)
+CREATE INDEX IF NOT EXISTS idx_face_embeddings_emb ON face_embeddings USING hnsw (emb vector_cosine_ops);
 
 -- Table: attendance
 -- Stores attendance records with timestamps
@@ -41,6 +43,46 @@ CREATE TABLE IF NOT EXISTS attendance (
 CREATE INDEX IF NOT EXISTS idx_attendance_user_id ON attendance(user_id);
 CREATE INDEX IF NOT EXISTS idx_attendance_timestamp ON attendance(timestamp DESC);
 CREATE INDEX IF NOT EXISTS idx_attendance_user_date ON attendance(user_id, DATE(timestamp));
+-- Covers the per-user daily COUNT (user_id = ? AND timestamp range) as an index-only scan
+CREATE INDEX IF NOT EXISTS idx_attendance_user_timestamp ON attendance(user_id, timestamp);
+
+-- Function: mark_attendance_if_allowed
+-- Counts today's records and inserts a new one in a single round trip
+-- (Database.try_mark_attendance). The per-user advisory lock serializes
+-- concurrent requests for the same user, so two of them can't both see
+-- count = max - 1 and both insert. Returns the new id (NULL when the limit
+-- was already reached) and the count before the insert.
+CREATE OR REPLACE FUNCTION mark_attendance_if_allowed(
+    p_user_id VARCHAR,
+    p_name VARCHAR,
+    p_confidence FLOAT,
+    p_timestamp TIMESTAMP WITH TIME ZONE,
+    p_day_start TIMESTAMP WITH TIME ZONE,
+    p_day_end TIMESTAMP WITH TIME ZONE,
+    p_max_per_day INT
+)
+RETURNS TABLE (attendance_id UUID, count_today INT)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('attendance:' || p_user_id));
+
+    SELECT count(*) INTO count_today
+    FROM attendance a
+    WHERE a.user_id = p_user_id
+      AND a.timestamp >= p_day_start
+      AND a.timestamp < p_day_end;
+
+    attendance_id := NULL;
+    IF count_today < p_max_per_day THEN
+        INSERT INTO attendance (user_id, name, timestamp, confidence)
+        VALUES (p_user_id, p_name, p_timestamp, p_confidence)
+        RETURNING id INTO attendance_id;
+    END IF;
+
+    RETURN NEXT;
+END;
+$$;
 
 -- Enable Row Level Security (RLS)
 ALTER TABLE face_embeddings ENABLE ROW LEVEL SECURITY;
@@ -79,6 +121,22 @@ WITH CHECK (true);
 -- ORDER BY timestamp DESC 
 -- LIMIT 30;
 
+-- Migrate an existing JSON TEXT embedding column to BYTEA
+-- The backend writes '\x...' hex literals and still reads legacy JSON rows,
+-- so a TEXT column keeps working. Once every row has been re-saved in hex
+-- form (no rows match embedding LIKE '[%'), convert the column in place:
+-- ALTER TABLE face_embeddings ALTER COLUMN embedding TYPE BYTEA
+-- USING decode(substring(embedding FROM 3), 'hex');
+
+-- Add the quantization scale column to an existing table
+-- ALTER TABLE face_embeddings ADD COLUMN IF NOT EXISTS embedding_scale REAL;
+
+-- Add the pgvector KNN column to an existing table (rows are filled on re-enroll).
+-- 512 is the embedding size of the default model; use the model's size and set
+-- PGVECTOR_DIM to the same value. Embeddings of any other size are stored
+-- without an emb copy (a warning is logged) instead of failing the enroll.
+-- ALTER TABLE face_embeddings ADD COLUMN IF NOT EXISTS emb vector(512);
+
 -- Delete all attendance records (for testing)
 -- DELETE FROM attendance;
 
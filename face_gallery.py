@@ -0,0 +1,453 @@
+"""
+Enrolled face encodings for the Flask face recognition service
+
+Keeps the gallery (one float32 (N, 128) matrix plus per-row employee
+metadata), matches query encodings against it, and persists it as a
+memory-mapped snapshot plus an append-only journal that several worker
+processes share. Only needs NumPy, so it can be used and tested without
+dlib or face_recognition.
+"""
+
+import os
+import json
+import pickle
+import struct
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no cross-process file lock, run a single process there
+    fcntl = None
+
+try:
+    import hnswlib
+except ImportError:
+    # Optional: approximate search for very large galleries (exact scan otherwise)
+    hnswlib = None
+
+# Storage for enrolled faces: one float32 (N, 128) encoding matrix plus
+# per-row employee metadata in the same order
+ENCODINGS_FILE = "face_encodings.npy"
+META_FILE = "face_encodings.json"
+# Enrolls and deletes since the last snapshot, replayed on load
+JOURNAL_FILE = "face_encodings.journal"
+# Held while the files are read or changed, so worker processes can share them
+LOCK_FILE = "face_encodings.lock"
+# Fold the journal into the snapshot once it grows past this size
+JOURNAL_COMPACT_BYTES = 1024 * 1024
+# Zero rows reserved at the end of each snapshot, so enrolls can be written
+# into the mapping instead of reallocating the matrix
+SNAPSHOT_SPARE_ROWS = 1024
+# The snapshot is memory-mapped copy-on-write: worker processes share its
+# pages through the page cache, and a change only copies the pages it
+# touches. Windows cannot replace a file that is still mapped, so it is
+# read into memory there
+SNAPSHOT_MMAP_MODE = 'c' if os.name != 'nt' else None
+# Pickle store used before the npy/json split, migrated on first load
+LEGACY_ENCODINGS_FILE = "face_encodings.pkl"
+
+# Journal records: b'E' + id + name + enrolled_at + 128 float32, or b'D' + id,
+# each string prefixed with its uint16 byte length
+JOURNAL_ENROLL = b'E'
+JOURNAL_DELETE = b'D'
+ENCODING_BYTES = 128 * 4
+
+# The gallery is stored column-wise: row i of encoding_matrix belongs to
+# employee_ids[i], employee_names[i] and employee_enrolled_at[i], so
+# matching only walks the matrix.
+# encoding_matrix is a view of the first len(employee_ids) rows of
+# gallery_storage, whose remaining rows are spare capacity.
+# encoding_sq_norms holds the squared L2 norm of each row, the same way
+gallery_storage = np.empty((0, 128), dtype=np.float32)
+encoding_matrix = gallery_storage
+sq_norm_storage = np.empty(0, dtype=np.float32)
+encoding_sq_norms = sq_norm_storage
+employee_ids = []
+employee_names = []
+employee_enrolled_at = []
+# employee_id -> row
+employee_rows = {}
+# Employees migrated from the pickle store, whose encodings were made with
+# the 68-point landmark model. Their rows are matched against a 68-point
+# encoding of the query until they re-enroll
+legacy_employee_ids = set()
+# Serializes access to the gallery within this process
+db_lock = threading.Lock()
+
+# Galleries at least this large are searched through an HNSW index
+# (pip install hnswlib) instead of a full scan (0 = always scan)
+ANN_MIN_GALLERY_SIZE = int(os.environ.get("ANN_MIN_GALLERY_SIZE", 20000))
+# Approximate neighbours re-ranked with exact distances
+ANN_CANDIDATES = 10
+# Index over encoding_matrix with matrix rows as labels, built on first use
+ann_index = None
+# Which snapshot is loaded and how much of the journal has been applied.
+# Changes made by other worker processes show up as a new snapshot or a
+# longer journal
+loaded_snapshot = None
+journal_offset = 0
+
+@contextmanager
+def files_locked():
+    """Exclusive lock on the encoding files across worker processes"""
+    with open(LOCK_FILE, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        # Closing the file releases the lock
+        yield
+
+def snapshot_id():
+    """Identity of the snapshot on disk, changes whenever it is rewritten"""
+    try:
+        st = os.stat(META_FILE)
+    except FileNotFoundError:
+        return 0
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def journal_size():
+    try:
+        return os.path.getsize(JOURNAL_FILE)
+    except FileNotFoundError:
+        return 0
+
+def set_gallery(storage, ids, names, enrolled_at, legacy_ids=()):
+    """Use storage's first len(ids) rows as the gallery"""
+    global gallery_storage, encoding_matrix, ann_index
+    global sq_norm_storage, encoding_sq_norms
+    global employee_ids, employee_names, employee_enrolled_at, employee_rows
+    global legacy_employee_ids
+    gallery_storage = storage
+    employee_ids, employee_names, employee_enrolled_at = ids, names, enrolled_at
+    employee_rows = {employee_id: row for row, employee_id in enumerate(ids)}
+    legacy_employee_ids = set(legacy_ids)
+    encoding_matrix = gallery_storage[:len(ids)]
+    sq_norm_storage = np.empty(len(storage), dtype=np.float32)
+    encoding_sq_norms = sq_norm_storage[:len(ids)]
+    np.einsum('ij,ij->i', encoding_matrix, encoding_matrix, out=encoding_sq_norms)
+    ann_index = None
+
+def store_employee(employee_id, name, enrolled_at, encoding):
+    """Add an employee's encoding, replacing the row of a re-enrolled one"""
+    global gallery_storage, encoding_matrix, sq_norm_storage, encoding_sq_norms
+    row = employee_rows.get(employee_id)
+    if row is None:
+        row = len(employee_ids)
+        if row == len(gallery_storage):
+            # Out of spare rows: move to a private copy with room to grow
+            capacity = max(2 * row, SNAPSHOT_SPARE_ROWS)
+            grown = np.empty((capacity, 128), dtype=np.float32)
+            grown[:row] = encoding_matrix
+            gallery_storage = grown
+        if row == len(sq_norm_storage):
+            grown_norms = np.empty(len(gallery_storage), dtype=np.float32)
+            grown_norms[:row] = encoding_sq_norms
+            sq_norm_storage = grown_norms
+        employee_ids.append(employee_id)
+        employee_names.append(name)
+        employee_enrolled_at.append(enrolled_at)
+        employee_rows[employee_id] = row
+        encoding_matrix = gallery_storage[:row + 1]
+        encoding_sq_norms = sq_norm_storage[:row + 1]
+    else:
+        employee_names[row] = name
+        employee_enrolled_at[row] = enrolled_at
+    # New encodings always come from the 5-point model
+    legacy_employee_ids.discard(employee_id)
+    encoding_matrix[row] = encoding
+    encoding_sq_norms[row] = encoding @ encoding
+    ann_set_row(row)
+
+def remove_employee(employee_id):
+    """Drop an employee's row, returning their name (None if not enrolled)"""
+    global encoding_matrix, encoding_sq_norms
+    row = employee_rows.pop(employee_id, None)
+    if row is None:
+        return None
+    legacy_employee_ids.discard(employee_id)
+    name = employee_names[row]
+    # Move the last row into the gap instead of shifting every row after it
+    last = len(employee_ids) - 1
+    if row != last:
+        encoding_matrix[row] = encoding_matrix[last]
+        encoding_sq_norms[row] = encoding_sq_norms[last]
+        employee_ids[row] = employee_ids[last]
+        employee_names[row] = employee_names[last]
+        employee_enrolled_at[row] = employee_enrolled_at[last]
+        employee_rows[employee_ids[row]] = row
+        ann_set_row(row)
+    employee_ids.pop()
+    employee_names.pop()
+    employee_enrolled_at.pop()
+    encoding_matrix = gallery_storage[:last]
+    encoding_sq_norms = sq_norm_storage[:last]
+    if ann_index is not None:
+        ann_index.mark_deleted(last)
+    return name
+
+def ann_set_row(row):
+    """Mirror one row of encoding_matrix into the HNSW index, if built"""
+    if ann_index is None:
+        return
+    if ann_index.get_current_count() >= ann_index.get_max_elements():
+        ann_index.resize_index(2 * ann_index.get_max_elements())
+    # Adding an existing (or deleted) label updates it in place
+    ann_index.add_items(encoding_matrix[row:row + 1], [row])
+
+def build_ann_index():
+    """Index the whole gallery for approximate nearest-neighbour search"""
+    global ann_index
+    count = len(employee_ids)
+    index = hnswlib.Index(space='l2', dim=128)
+    index.init_index(max_elements=max(2 * count, 1024), M=16, ef_construction=200)
+    index.add_items(encoding_matrix, np.arange(count))
+    index.set_ef(64)
+    ann_index = index
+
+def nearest_employees(queries, legacy_queries=None):
+    """
+    Rows and Euclidean distances of the closest enrolled face to each of (B, 128) queries
+    legacy_queries holds the same faces encoded with the 68-point model, for
+    the rows in legacy_employee_ids
+    """
+    count = len(employee_ids)
+    picks = np.arange(len(queries))
+    legacy_rows = None
+    if legacy_queries is not None and legacy_employee_ids:
+        legacy_rows = np.array([employee_rows[e] for e in legacy_employee_ids], dtype=np.intp)
+    # A gallery that still holds 68-point rows is scanned exactly, the index
+    # only takes one query per face
+    if legacy_rows is None and hnswlib is not None and 0 < ANN_MIN_GALLERY_SIZE <= count:
+        if ann_index is None:
+            build_ann_index()
+        labels, _ = ann_index.knn_query(queries, k=min(ANN_CANDIDATES, count))
+        rows = labels.astype(np.intp)
+        distances = np.linalg.norm(encoding_matrix[rows] - queries[:, None, :], axis=2)
+        best = distances.argmin(axis=1)
+        return rows[picks, best], distances[picks, best]
+
+    # ||e - q||^2 = ||e||^2 - 2 e.q + ||q||^2: one matrix product over the
+    # gallery for all queries, with the row norms cached. ||q||^2 is the same
+    # for every row, so it does not change the argmin of a column
+    scores = encoding_sq_norms[:, None] - 2.0 * (encoding_matrix @ queries.T)
+    targets = queries
+    if legacy_rows is not None:
+        # 68-point rows are scored against the other query, whose dropped
+        # ||q||^2 differs, so they carry the difference
+        offset = (np.einsum('ij,ij->i', legacy_queries, legacy_queries)
+                  - np.einsum('ij,ij->i', queries, queries))
+        scores[legacy_rows] = (encoding_sq_norms[legacy_rows, None]
+                               - 2.0 * (encoding_matrix[legacy_rows] @ legacy_queries.T)
+                               + offset)
+    best = scores.argmin(axis=0)
+    if legacy_rows is not None:
+        targets = np.where(np.isin(best, legacy_rows)[:, None], legacy_queries, queries)
+    # Exact distances for the winners, free of the expansion's rounding
+    return best, np.linalg.norm(encoding_matrix[best] - targets, axis=1)
+
+def match_encodings(queries, legacy_queries=None):
+    """(employee_id, name, distance) of the closest enrolled face per query, None if the gallery is empty"""
+    with db_lock:
+        if len(employee_ids) == 0:
+            return [None] * len(queries)
+        rows, distances = nearest_employees(queries, legacy_queries)
+        return [(employee_ids[row], employee_names[row], float(distance))
+                for row, distance in zip(rows, distances)]
+
+def pack_string(value):
+    """uint16 length-prefixed UTF-8 bytes"""
+    data = value.encode('utf-8')
+    return struct.pack('<H', len(data)) + data
+
+def unpack_string(buf, offset):
+    """Read a pack_string value, returning it and the offset after it"""
+    (length,) = struct.unpack_from('<H', buf, offset)
+    offset += 2
+    return buf[offset:offset + length].decode('utf-8'), offset + length
+
+# The functions below expect db_lock and files_locked() to be held
+
+def append_journal(record):
+    """Append one record, compacting the journal when it gets large"""
+    global journal_offset
+    with open(JOURNAL_FILE, 'ab') as f:
+        f.write(record)
+        journal_offset = f.tell()
+    if journal_offset > JOURNAL_COMPACT_BYTES:
+        save_encodings()
+
+def journal_enroll(employee_id, name, enrolled_at, encoding):
+    """Record an enroll or re-enroll"""
+    append_journal(
+        JOURNAL_ENROLL
+        + pack_string(employee_id)
+        + pack_string(name)
+        + pack_string(enrolled_at)
+        + encoding.astype('<f4').tobytes()
+    )
+
+def journal_delete(employee_id):
+    """Record a delete (tombstone)"""
+    append_journal(JOURNAL_DELETE + pack_string(employee_id))
+
+def replay_journal():
+    """Apply the journal records past journal_offset, returning how many"""
+    global journal_offset
+    if not os.path.exists(JOURNAL_FILE):
+        return 0
+    with open(JOURNAL_FILE, 'rb') as f:
+        f.seek(journal_offset)
+        buf = f.read()
+    offset, count = 0, 0
+    while offset < len(buf):
+        try:
+            op = buf[offset:offset + 1]
+            employee_id, end = unpack_string(buf, offset + 1)
+            if op == JOURNAL_ENROLL:
+                name, end = unpack_string(buf, end)
+                enrolled_at, end = unpack_string(buf, end)
+                encoding = np.frombuffer(buf, dtype='<f4', count=128, offset=end)
+                end += ENCODING_BYTES
+                store_employee(employee_id, name, enrolled_at, encoding.astype(np.float32))
+            elif op == JOURNAL_DELETE and end <= len(buf):
+                remove_employee(employee_id)
+            else:
+                break
+        except (struct.error, UnicodeDecodeError, ValueError):
+            break
+        offset = end
+        count += 1
+    journal_offset += offset
+    if offset < len(buf):
+        # Torn write from a crash mid-append (appends hold the file lock, so
+        # nobody is still writing it): cut it off so new records are not
+        # appended after garbage
+        print("Dropping incomplete record at the end of the journal")
+        with open(JOURNAL_FILE, 'r+b') as f:
+            f.truncate(journal_offset)
+    return count
+
+def read_snapshot():
+    """Load the snapshot from disk, then replay the journal on top"""
+    global loaded_snapshot, journal_offset
+    if os.path.exists(ENCODINGS_FILE) and os.path.exists(META_FILE):
+        map_snapshot()
+    elif os.path.exists(LEGACY_ENCODINGS_FILE):
+        with open(LEGACY_ENCODINGS_FILE, 'rb') as f:
+            legacy_db = pickle.load(f)
+        storage = np.empty((len(legacy_db), 128), dtype=np.float32)
+        for row, data in enumerate(legacy_db.values()):
+            storage[row] = data['encoding']
+        set_gallery(
+            storage,
+            list(legacy_db),
+            [data['name'] for data in legacy_db.values()],
+            [data.get('enrolled_at', 'Unknown') for data in legacy_db.values()],
+            # The pickle store encoded faces with the 68-point landmark model
+            list(legacy_db)
+        )
+        save_encodings()
+        print(f"Migrated {len(employee_ids)} enrolled faces from {LEGACY_ENCODINGS_FILE}")
+    else:
+        set_gallery(np.empty((0, 128), dtype=np.float32), [], [], [])
+    loaded_snapshot = snapshot_id()
+    journal_offset = 0
+    return replay_journal()
+
+def map_snapshot():
+    """Map the snapshot matrix and read its metadata"""
+    with open(META_FILE, 'r') as f:
+        meta = json.load(f)
+    storage = np.load(ENCODINGS_FILE, mmap_mode=SNAPSHOT_MMAP_MODE)
+    set_gallery(storage, meta['employee_id'], meta['name'], meta['enrolled_at'],
+                meta['legacy_68_point'])
+
+def catch_up():
+    """Pick up changes other processes wrote since the last load"""
+    if snapshot_id() != loaded_snapshot or journal_size() < journal_offset:
+        read_snapshot()
+    elif journal_size() > journal_offset:
+        replay_journal()
+
+def save_encodings():
+    """Write a full snapshot of the face encodings and empty the journal"""
+    global loaded_snapshot, journal_offset, ann_index
+    # Write-then-rename so a crash leaves the previous snapshot intact; the
+    # journal still holds every change since then
+    count = len(employee_ids)
+    out = np.lib.format.open_memmap(
+        ENCODINGS_FILE + '.tmp', mode='w+', dtype=np.float32,
+        shape=(count + max(SNAPSHOT_SPARE_ROWS, count // 4), 128)
+    )
+    out[:count] = encoding_matrix
+    out.flush()
+    del out
+    with open(META_FILE + '.tmp', 'w') as f:
+        json.dump({
+            "employee_id": employee_ids,
+            "name": employee_names,
+            "enrolled_at": employee_enrolled_at,
+            "legacy_68_point": sorted(legacy_employee_ids)
+        }, f)
+    os.replace(ENCODINGS_FILE + '.tmp', ENCODINGS_FILE)
+    os.replace(META_FILE + '.tmp', META_FILE)
+    if os.path.exists(JOURNAL_FILE):
+        os.remove(JOURNAL_FILE)
+    # Switch to the new file too, so this process shares its pages as well;
+    # the rows are unchanged, so the index stays valid
+    index = ann_index
+    map_snapshot()
+    ann_index = index
+    loaded_snapshot = snapshot_id()
+    journal_offset = 0
+    print(f"Saved {len(employee_ids)} face encodings")
+
+def load_encodings():
+    """Load saved face encodings from file"""
+    with db_lock, files_locked():
+        replayed = read_snapshot()
+    if employee_ids or replayed:
+        print(f"Loaded {len(employee_ids)} enrolled faces ({replayed} from the journal)")
+    else:
+        print("No existing encodings found, starting fresh")
+    if legacy_employee_ids:
+        print(f"WARNING: {len(legacy_employee_ids)} enrolled faces were encoded with the "
+              "68-point landmark model. They are still matched with it, which costs a "
+              "second encoding per /identify, until each employee re-enrolls "
+              "(see needs_reenroll in /list)")
+
+def refresh_encodings():
+    """Catch up with changes from other workers; two stat calls when there are none"""
+    if (loaded_snapshot is not None and snapshot_id() == loaded_snapshot
+            and journal_size() == journal_offset):
+        return
+    with db_lock, files_locked():
+        catch_up()
+
+def enroll_employee(employee_id, name, enrolled_at, encoding):
+    """Store and journal an enroll or re-enroll"""
+    with db_lock, files_locked():
+        catch_up()
+        store_employee(employee_id, name, enrolled_at, encoding)
+        journal_enroll(employee_id, name, enrolled_at, encoding)
+
+def delete_employee(employee_id):
+    """Remove and journal an employee, returning their name (None if not enrolled)"""
+    with db_lock, files_locked():
+        catch_up()
+        name = remove_employee(employee_id)
+        if name is not None:
+            journal_delete(employee_id)
+    return name
+
+def clear_gallery():
+    """Remove every enrolled face, returning how many there were"""
+    with db_lock, files_locked():
+        catch_up()
+        count = len(employee_ids)
+        set_gallery(np.empty((0, 128), dtype=np.float32), [], [], [])
+        save_encodings()
+    return count
@@ -4,56 +4,253 @@ Uses face_recognition library for better accuracy
 """
 
 from flask import Flask, request, jsonify
-import face_recognition
+from flask.json.provider import DefaultJSONProvider
+from face_recognition import api as face_api
+import dlib
 import numpy as np
 import cv2
 import base64
-import pickle
 import os
-import json
+import threading
+import queue
+import time
+from concurrent.futures import Future
 from datetime import datetime
+import face_gallery as gallery
 
-app = Flask(__name__)
+try:
+    import orjson
+except ImportError:
+    # Optional: faster request parsing and responses (Flask's json otherwise)
+    orjson = None
 
-# Storage for enrolled faces
-ENCODINGS_FILE = "face_encodings.pkl"
-encodings_db = {}
-
-def load_encodings():
-    """Load saved face encodings from file"""
-    global encodings_db
-    if os.path.exists(ENCODINGS_FILE):
-        with open(ENCODINGS_FILE, 'rb') as f:
-            encodings_db = pickle.load(f)
-        print(f"Loaded {len(encodings_db)} enrolled faces")
-    else:
-        encodings_db = {}
-        print("No existing encodings found, starting fresh")
+app = Flask(__name__)
 
-def save_encodings():
-    """Save face encodings to file"""
-    with open(ENCODINGS_FILE, 'wb') as f:
-        pickle.dump(encodings_db, f)
-    print(f"Saved {len(encodings_db)} face encodings")
+if orjson is not None:
+    class OrjsonProvider(DefaultJSONProvider):
+        """JSON provider for request.get_json() and jsonify() backed by orjson"""
+
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+    app.json = OrjsonProvider(app)
+
+# Larger JPEGs are decoded at 1/2, 1/4 or 1/8 scale as long as the
+# longest side stays at least this big
+MAX_IMAGE_DIM = 640
+REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+# SOF0-SOF15 except DHT, JPG and DAC
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+def jpeg_dimensions(data):
+    """Read (height, width) from a JPEG header, or None if not a JPEG"""
+    if data[:2] != b'\xff\xd8':
+        return None
+    i, n = 2, len(data)
+    while i + 4 <= n:
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            i += 2
+        elif marker == 0xDA:
+            return None
+        elif marker in JPEG_SOF_MARKERS:
+            if i + 9 > n:
+                return None
+            return (data[i + 5] << 8) | data[i + 6], (data[i + 7] << 8) | data[i + 8]
+        else:
+            i += 2 + ((data[i + 2] << 8) | data[i + 3])
+    return None
 
 def base64_to_image(base64_string):
-    """Convert base64 string to OpenCV image"""
+    """
+    Convert base64 string to OpenCV image
+    Returns (image, scale) where scale maps image coordinates back to the upload
+    """
     img_data = base64.b64decode(base64_string)
     nparr = np.frombuffer(img_data, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    flag, scale = cv2.IMREAD_COLOR, 1
+    dims = jpeg_dimensions(img_data)
+    if dims is not None:
+        for factor, reduced_flag in REDUCED_DECODE_FLAGS:
+            if max(dims) // factor >= MAX_IMAGE_DIM:
+                flag, scale = reduced_flag, factor
+                break
+    img = cv2.imdecode(nparr, flag)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB), scale
+
+# dlib models face_recognition loads once at import. Calling them directly
+# skips its rectangle <-> tuple round trips and encodes only the face used.
+# The 5-point landmark model (face_recognition's model="small") is enough to
+# align the face for the encoder and is much faster than the 68-point one.
+# The two give different encodings, so faces migrated from the pickle store
+# (gallery.legacy_employee_ids) are matched with the 68-point model until re-enrolled
+face_detector = face_api.face_detector
+shape_predictor = face_api.pose_predictor_5_point
+legacy_shape_predictor = face_api.pose_predictor_68_point
+face_encoder = face_api.face_encoder
+
+# Optional YuNet detector (cv2.FaceDetectorYN, OpenCV 4.8+): a small CNN that
+# is several times faster than dlib's HOG and finds smaller faces. Used when
+# face_detection_yunet_2023mar.onnx from the OpenCV model zoo is present,
+# otherwise detection falls back to HOG
+YUNET_MODEL_FILE = os.environ.get("YUNET_MODEL", "face_detection_yunet_2023mar.onnx")
+# Images are shrunk to fit this size (width, height) for YuNet only; the
+# encoder still crops from the decoded image
+YUNET_INPUT_SIZE = (320, 240)
+if hasattr(cv2, 'FaceDetectorYN') and os.path.exists(YUNET_MODEL_FILE):
+    yunet_detector = cv2.FaceDetectorYN.create(YUNET_MODEL_FILE, "", YUNET_INPUT_SIZE)
+    print(f"Using YuNet face detector ({YUNET_MODEL_FILE})")
+else:
+    yunet_detector = None
+# The cv2.dnn network behind YuNet is not safe to run from several threads
+yunet_lock = threading.Lock()
+
+def detect_faces(image):
+    """Face detection as dlib rectangles, YuNet if available else HOG with one upsample"""
+    if yunet_detector is None:
+        return face_detector(image, 1)
+
+    height, width = image.shape[:2]
+    ratio = min(YUNET_INPUT_SIZE[0] / width, YUNET_INPUT_SIZE[1] / height, 1.0)
+    size = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+    small = cv2.resize(image, size, interpolation=cv2.INTER_AREA) if ratio < 1.0 else image
+    # YuNet was trained on BGR input
+    small = cv2.cvtColor(small, cv2.COLOR_RGB2BGR)
+    with yunet_lock:
+        yunet_detector.setInputSize(size)
+        _, faces = yunet_detector.detect(small)
+    if faces is None:
+        return []
+
+    # Rows are x, y, w, h, five landmarks, score
+    rects = []
+    for x, y, w, h in faces[:, :4] / ratio:
+        rects.append(dlib.rectangle(
+            max(int(x), 0), max(int(y), 0),
+            min(int(x + w), width - 1), min(int(y + h), height - 1)
+        ))
+    return rects
+
+def encode_face(image, rect, predictor=shape_predictor):
+    """128-d float32 encoding of one detected face"""
+    landmarks = predictor(image, rect)
+    # num_jitters=1: a single pass, no random re-crops
+    return np.array(face_encoder.compute_face_descriptor(image, landmarks, 1), dtype=np.float32)
+
+def encode_faces(images, rects, predictor=shape_predictor):
+    """(B, 128) float32 encodings of one detected face per image, in one dlib call"""
+    if len(images) == 1:
+        return encode_face(images[0], rects[0], predictor)[None, :]
+    shapes = []
+    for image, rect in zip(images, rects):
+        detections = dlib.full_object_detections()
+        detections.append(predictor(image, rect))
+        shapes.append(detections)
+    # Batched overload: one list of descriptors per image
+    descriptors = face_encoder.compute_face_descriptor(images, shapes, 1)
+    return np.array([faces[0] for faces in descriptors], dtype=np.float32)
+
+def identify_faces(images, rects):
+    """(employee_id, name, distance) of the closest enrolled face for one detected face per image"""
+    encodings = encode_faces(images, rects)
+    legacy_encodings = None
+    if gallery.legacy_employee_ids:
+        legacy_encodings = encode_faces(images, rects, legacy_shape_predictor)
+    return gallery.match_encodings(encodings, legacy_encodings)
+
+# Concurrent /identify requests whose faces arrive within this window are
+# encoded and matched as one batch (0 = off, every request runs on its own).
+# Only pays off with several threads per worker, see GUNICORN_THREADS
+IDENTIFY_BATCH_WINDOW_MS = float(os.environ.get("IDENTIFY_BATCH_WINDOW_MS", 0))
+IDENTIFY_MAX_BATCH_SIZE = int(os.environ.get("IDENTIFY_MAX_BATCH_SIZE", 8))
+
+class IdentifyBatcher:
+    """
+    Coalesces faces from concurrent /identify requests into one encoder call
+    and one gallery matrix product
+
+    - The first waiting face opens a window of window_ms; the batch runs when
+      it closes or max_batch_size faces are waiting
+    - A single background thread runs the batches, started lazily so each
+      gunicorn worker gets its own after the fork
+    - Errors are re-raised in every request of the failed batch
+    """
 
-def image_to_base64(image):
-    """Convert OpenCV image to base64 string"""
-    _, buffer = cv2.imencode('.jpg', cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
-    return base64.b64encode(buffer).decode('utf-8')
+    def __init__(self, window_ms=5.0, max_batch_size=8):
+        self._window = window_ms / 1000.0
+        self._max_batch_size = max(1, max_batch_size)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+
+    def identify(self, image, rect):
+        """(employee_id, name, distance) of the closest enrolled face, None if the gallery is empty"""
+        future = Future()
+        self._start().put((image, rect, future))
+        return future.result()
+
+    def _start(self):
+        with self._lock:
+            # Threads do not survive fork, a preloaded app starts one per worker
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                threading.Thread(target=self._loop, args=(self._queue,),
+                                 name="identify-batcher", daemon=True).start()
+                self._pid = os.getpid()
+            return self._queue
+
+    def _loop(self, pending):
+        while True:
+            batch = [pending.get()]
+            deadline = time.monotonic() + self._window
+            while len(batch) < self._max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._run(batch)
+
+    def _run(self, batch):
+        try:
+            matches = identify_faces([item[0] for item in batch], [item[1] for item in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, _, future), match in zip(batch, matches):
+            future.set_result(match)
+
+identify_batcher = (IdentifyBatcher(IDENTIFY_BATCH_WINDOW_MS, IDENTIFY_MAX_BATCH_SIZE)
+                    if IDENTIFY_BATCH_WINDOW_MS > 0 else None)
+
+def face_location(rect, image, scale):
+    """dlib rectangle -> (top, right, bottom, left) in upload coordinates"""
+    height, width = image.shape[:2]
+    location = (max(rect.top(), 0), min(rect.right(), width),
+                min(rect.bottom(), height), max(rect.left(), 0))
+    return tuple(v * scale for v in location)
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
+    gallery.refresh_encodings()
     return jsonify({
         "status": "ok",
-        "enrolled_count": len(encodings_db),
+        "enrolled_count": len(gallery.employee_ids),
         "timestamp": datetime.now().isoformat()
     })
 
@@ -77,40 +274,32 @@ def enroll_face():
             return jsonify({"error": "Missing required fields"}), 400
 
         # Convert base64 to image
-        image = base64_to_image(image_base64)
+        image, scale = base64_to_image(image_base64)
 
         # Detect faces
-        face_locations = face_recognition.face_locations(image, model="hog")
+        faces = detect_faces(image)
         
-        if len(face_locations) == 0:
+        if len(faces) == 0:
             return jsonify({"error": "No face detected"}), 400
         
-        if len(face_locations) > 1:
+        if len(faces) > 1:
             return jsonify({"error": "Multiple faces detected"}), 400
 
         # Get face encoding
-        face_encodings = face_recognition.face_encodings(image, face_locations)
-        
-        if len(face_encodings) == 0:
-            return jsonify({"error": "Could not encode face"}), 400
+        encoding = encode_face(image, faces[0])
 
-        encoding = face_encodings[0]
-
-        # Store encoding
-        encodings_db[employee_id] = {
-            "employee_id": employee_id,
-            "name": name,
-            "encoding": encoding.tolist(),
-            "enrolled_at": datetime.now().isoformat()
-        }
+        if not np.isfinite(encoding).all():
+            return jsonify({"error": "Could not encode face"}), 400
 
-        save_encodings()
+        # Store encoding, replacing the row of a re-enrolled employee
+        enrolled_at = datetime.now().isoformat()
+        gallery.enroll_employee(employee_id, name, enrolled_at, encoding)
 
         return jsonify({
             "success": True,
             "message": f"Successfully enrolled {name}",
             "employee_id": employee_id,
-            "face_location": face_locations[0]
+            "face_location": face_location(faces[0], image, scale)
         })
 
     except Exception as e:
@@ -134,47 +323,31 @@ def identify_face():
         if not image_base64:
             return jsonify({"error": "Missing image"}), 400
 
-        if len(encodings_db) == 0:
+        gallery.refresh_encodings()
+        if len(gallery.employee_ids) == 0:
             return jsonify({"error": "No enrolled faces in database"}), 400
 
         # Convert base64 to image
-        image = base64_to_image(image_base64)
+        image, scale = base64_to_image(image_base64)
 
         # Detect faces
-        face_locations = face_recognition.face_locations(image, model="hog")
+        faces = detect_faces(image)
         
-        if len(face_locations) == 0:
+        if len(faces) == 0:
             return jsonify({
                 "identified": False,
                 "message": "No face detected"
             })
 
-        # Get face encodings
-        face_encodings = face_recognition.face_encodings(image, face_locations)
-        
-        if len(face_encodings) == 0:
-            return jsonify({
-                "identified": False,
-                "message": "Could not encode face"
-            })
-
-        # Compare with all enrolled faces
-        unknown_encoding = face_encodings[0]
-        
-        best_match_id = None
-        best_match_distance = float('inf')
-        best_match_name = None
-
-        for employee_id, data in encodings_db.items():
-            known_encoding = np.array(data['encoding'])
-            
-            # Calculate face distance (lower is better)
-            distance = face_recognition.face_distance([known_encoding], unknown_encoding)[0]
-            
-            if distance < best_match_distance:
-                best_match_distance = distance
-                best_match_id = employee_id
-                best_match_name = data['name']
+        # Encode the first face only, it is the one matched, and compare
+        # with all enrolled faces in one pass
+        if identify_batcher is not None:
+            match = identify_batcher.identify(image, faces[0])
+        else:
+            match = identify_faces([image], [faces[0]])[0]
+        if match is None:
+            return jsonify({"error": "No enrolled faces in database"}), 400
+        best_match_id, best_match_name, best_match_distance = match
 
         # Convert distance to similarity (0-1 scale, higher is better)
         similarity = 1.0 - best_match_distance
@@ -186,7 +359,7 @@ def identify_face():
                 "name": best_match_name,
                 "similarity": float(similarity),
                 "distance": float(best_match_distance),
-                "face_location": face_locations[0]
+                "face_location": face_location(faces[0], image, scale)
             })
         else:
             return jsonify({
@@ -205,25 +378,23 @@ def identify_face():
 @app.route('/list', methods=['GET'])
 def list_enrolled():
     """List all enrolled faces"""
-    enrolled = []
-    for employee_id, data in encodings_db.items():
-        enrolled.append({
-            "employee_id": employee_id,
-            "name": data['name'],
-            "enrolled_at": data.get('enrolled_at', 'Unknown')
+    gallery.refresh_encodings()
+    with gallery.db_lock:
+        return jsonify({
+            "count": len(gallery.employee_ids),
+            "enrolled": [
+                {"employee_id": employee_id, "name": name, "enrolled_at": enrolled_at,
+                 "needs_reenroll": employee_id in gallery.legacy_employee_ids}
+                for employee_id, name, enrolled_at
+                in zip(gallery.employee_ids, gallery.employee_names, gallery.employee_enrolled_at)
+            ]
         })
-    return jsonify({
-        "count": len(enrolled),
-        "enrolled": enrolled
-    })
 
 @app.route('/delete/<employee_id>', methods=['DELETE'])
 def delete_face(employee_id):
     """Delete an enrolled face"""
-    if employee_id in encodings_db:
-        name = encodings_db[employee_id]['name']
-        del encodings_db[employee_id]
-        save_encodings()
+    name = gallery.delete_employee(employee_id)
+    if name is not None:
         return jsonify({
             "success": True,
             "message": f"Deleted {name}"
@@ -234,17 +405,16 @@ def delete_face(employee_id):
 @app.route('/clear', methods=['POST'])
 def clear_all():
     """Clear all enrolled faces"""
-    global encodings_db
-    count = len(encodings_db)
-    encodings_db = {}
-    save_encodings()
+    count = gallery.clear_gallery()
     return jsonify({
         "success": True,
         "message": f"Cleared {count} enrolled faces"
     })
 
 if __name__ == '__main__':
-    load_encodings()
+    # Development server. In production run several workers with:
+    #   gunicorn -c gunicorn.conf.py face_recognition_service:app
+    gallery.load_encodings()
     print("Starting Face Recognition Service...")
-    print("Enrolled faces:", len(encodings_db))
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    print("Enrolled faces:", len(gallery.employee_ids))
+    app.run(host='0.0.0.0', port=5000)
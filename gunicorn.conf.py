@@ -0,0 +1,26 @@
+"""
+Gunicorn settings for the face recognition service
+
+    gunicorn -c gunicorn.conf.py face_recognition_service:app
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+# Detection and encoding are CPU-bound: one worker process per core
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+# A second thread reads the next upload while the first one computes;
+# set GUNICORN_THREADS=1 to run strictly one request per core
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 2))
+timeout = 60
+
+# Import the app, and with it dlib's models, in the master so forked workers
+# share those pages copy-on-write instead of loading their own copies
+preload_app = True
+
+def when_ready(server):
+    # Load the gallery once before forking; workers then only replay changes
+    # made after that (see refresh_encodings)
+    from face_gallery import load_encodings
+    load_encodings()
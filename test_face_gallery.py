@@ -0,0 +1,229 @@
+"""
+Tests for face_gallery's snapshot + journal persistence
+Run with: python -m pytest -q test_face_gallery.py (needs only NumPy)
+"""
+import multiprocessing
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+import face_gallery as gallery
+
+
+def encoding_for(employee_id, version=0):
+    """Deterministic float32 encoding per (employee, enroll)"""
+    seed = sum(employee_id.encode('utf-8')) * 1000 + version
+    return np.random.default_rng(seed).standard_normal(128).astype(np.float32)
+
+
+def as_dict():
+    """employee_id -> (name, encoding) of the loaded gallery"""
+    return {
+        employee_id: (gallery.employee_names[row], gallery.encoding_matrix[row].copy())
+        for employee_id, row in gallery.employee_rows.items()
+    }
+
+
+def reload():
+    """Load from disk the way a freshly started worker would"""
+    gallery.load_encodings()
+    return as_dict()
+
+
+@pytest.fixture(autouse=True)
+def gallery_dir(tmp_path, monkeypatch):
+    # The encoding files are relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    gallery.load_encodings()
+    return tmp_path
+
+
+def test_replay_after_enroll_and_delete():
+    for employee_id in ('a', 'b', 'c'):
+        gallery.enroll_employee(employee_id, employee_id.upper(), 't', encoding_for(employee_id))
+    assert gallery.delete_employee('b') == 'B'
+    gallery.enroll_employee('a', 'A2', 't', encoding_for('a', 1))
+    assert gallery.delete_employee('missing') is None
+
+    # No snapshot was written: everything comes back from the journal
+    assert not os.path.exists(gallery.META_FILE)
+    loaded = reload()
+    assert sorted(loaded) == ['a', 'c']
+    assert loaded['a'][0] == 'A2'
+    np.testing.assert_array_equal(loaded['a'][1], encoding_for('a', 1))
+    np.testing.assert_array_equal(loaded['c'][1], encoding_for('c'))
+
+
+def test_torn_final_record_is_dropped():
+    gallery.enroll_employee('a', 'A', 't', encoding_for('a'))
+    intact = os.path.getsize(gallery.JOURNAL_FILE)
+    gallery.enroll_employee('b', 'B', 't', encoding_for('b'))
+    # Crash in the middle of the second append
+    with open(gallery.JOURNAL_FILE, 'r+b') as f:
+        f.truncate(intact + 20)
+
+    assert sorted(reload()) == ['a']
+    assert os.path.getsize(gallery.JOURNAL_FILE) == intact
+
+    # New records go after the last intact one, not after the garbage
+    gallery.enroll_employee('c', 'C', 't', encoding_for('c'))
+    loaded = reload()
+    assert sorted(loaded) == ['a', 'c']
+    np.testing.assert_array_equal(loaded['c'][1], encoding_for('c'))
+
+
+def test_compaction_then_replay(monkeypatch):
+    # Compact about every second enroll record
+    monkeypatch.setattr(gallery, 'JOURNAL_COMPACT_BYTES', 2 * gallery.ENCODING_BYTES)
+    ids = [f"e{i}" for i in range(9)]
+    for employee_id in ids:
+        gallery.enroll_employee(employee_id, employee_id.upper(), 't', encoding_for(employee_id))
+    assert os.path.exists(gallery.META_FILE)
+    gallery.delete_employee('e0')
+    gallery.enroll_employee('e4', 'E4b', 't', encoding_for('e4', 1))
+    with gallery.db_lock, gallery.files_locked():
+        gallery.save_encodings()
+    assert not os.path.exists(gallery.JOURNAL_FILE)
+    # Changes after the last compaction live only in the journal
+    gallery.delete_employee('e8')
+    gallery.enroll_employee('x', 'X', 't', encoding_for('x'))
+
+    loaded = reload()
+    assert sorted(loaded) == sorted(ids[1:8] + ['x'])
+    assert loaded['e4'][0] == 'E4b'
+    for employee_id, (_, encoding) in loaded.items():
+        version = 1 if employee_id == 'e4' else 0
+        np.testing.assert_array_equal(encoding, encoding_for(employee_id, version))
+
+
+def assert_rows_in_sync():
+    """ids, names, rows, squared norms and (if built) ANN labels agree"""
+    assert len(gallery.employee_ids) == len(gallery.employee_names) == len(gallery.encoding_matrix)
+    assert gallery.employee_rows == {e: row for row, e in enumerate(gallery.employee_ids)}
+    for row, employee_id in enumerate(gallery.employee_ids):
+        assert gallery.employee_names[row] == employee_id.upper()
+        np.testing.assert_array_equal(gallery.encoding_matrix[row], encoding_for(employee_id))
+    np.testing.assert_allclose(
+        gallery.encoding_sq_norms,
+        np.einsum('ij,ij->i', gallery.encoding_matrix, gallery.encoding_matrix), rtol=1e-6)
+    if gallery.ann_index is not None:
+        labels, _ = gallery.ann_index.knn_query(gallery.encoding_matrix, k=1)
+        np.testing.assert_array_equal(labels[:, 0], np.arange(len(gallery.employee_ids)))
+
+
+@pytest.mark.parametrize('ann', [False, True])
+def test_swap_delete_keeps_rows_in_sync(ann, monkeypatch):
+    if ann:
+        if gallery.hnswlib is None:
+            pytest.skip("hnswlib not installed")
+        monkeypatch.setattr(gallery, 'ANN_MIN_GALLERY_SIZE', 1)
+    for employee_id in ('a', 'b', 'c', 'd'):
+        gallery.enroll_employee(employee_id, employee_id.upper(), 't', encoding_for(employee_id))
+    # Builds the index on first use when ann is set
+    assert gallery.match_encodings(encoding_for('a')[None])[0][0] == 'a'
+    assert (gallery.ann_index is not None) == ann
+
+    # A middle row: the last row ('d') moves into its place
+    assert gallery.delete_employee('b') == 'B'
+    assert gallery.employee_rows['d'] == 1
+    assert_rows_in_sync()
+
+    # The next enroll reuses the freed last row
+    gallery.enroll_employee('e', 'E', 't', encoding_for('e'))
+    assert gallery.employee_rows['e'] == 3
+    assert_rows_in_sync()
+
+    queries = np.stack([encoding_for(e) for e in ('a', 'c', 'd', 'e', 'b')])
+    matches = gallery.match_encodings(queries)
+    assert [m[0] for m in matches[:4]] == ['a', 'c', 'd', 'e']
+    assert all(m[2] == pytest.approx(0.0, abs=1e-5) for m in matches[:4])
+    # The deleted face no longer matches itself
+    assert matches[4][0] != 'b' and matches[4][2] > 1.0
+
+    assert sorted(reload()) == ['a', 'c', 'd', 'e']
+    assert_rows_in_sync()
+
+
+@pytest.mark.skipif(gallery.hnswlib is None, reason="hnswlib not installed")
+def test_ann_reuses_deleted_label(monkeypatch):
+    monkeypatch.setattr(gallery, 'ANN_MIN_GALLERY_SIZE', 1)
+    for employee_id in ('a', 'b', 'c'):
+        gallery.enroll_employee(employee_id, employee_id.upper(), 't', encoding_for(employee_id))
+    gallery.match_encodings(encoding_for('a')[None])
+    index = gallery.ann_index
+
+    # Deleting the last row marks its label deleted...
+    gallery.delete_employee('c')
+    labels, _ = index.knn_query(encoding_for('c'), k=2)
+    assert 2 not in labels[0]
+    # ...and the next enroll writes the same label back, which has to be
+    # searchable again (add_items un-deletes an existing label)
+    gallery.enroll_employee('d', 'D', 't', encoding_for('d'))
+    assert gallery.ann_index is index and gallery.employee_rows['d'] == 2
+    labels, _ = index.knn_query(encoding_for('d'), k=1)
+    assert labels[0][0] == 2
+    assert gallery.match_encodings(encoding_for('d')[None])[0][0] == 'd'
+
+
+def test_legacy_rows_match_the_68_point_query():
+    # A migrated pickle store: encodings made with the 68-point model
+    rng = np.random.default_rng(7)
+    faces = {e: rng.standard_normal(128).astype(np.float32) for e in ('old', 'new')}
+    # The 68-point encoding of a face is far from its 5-point one, with a
+    # different norm, so scoring both against one query would pick wrong
+    shift = 3 * rng.standard_normal(128).astype(np.float32)
+    with open(gallery.LEGACY_ENCODINGS_FILE, 'wb') as f:
+        pickle.dump({'old': {'name': 'OLD', 'encoding': faces['old'] + shift}}, f)
+    gallery.load_encodings()
+    assert gallery.legacy_employee_ids == {'old'}
+    gallery.enroll_employee('new', 'NEW', 't', faces['new'])
+
+    queries_5_point = np.stack([faces['old'], faces['new']])
+    queries_68_point = queries_5_point + shift
+    matches = gallery.match_encodings(queries_5_point, queries_68_point)
+    assert [m[0] for m in matches] == ['old', 'new']
+    assert all(m[2] == pytest.approx(0.0, abs=1e-4) for m in matches)
+
+    # The flag survives compaction and clears on re-enroll
+    with gallery.db_lock, gallery.files_locked():
+        gallery.save_encodings()
+    reload()
+    assert gallery.legacy_employee_ids == {'old'}
+    gallery.enroll_employee('old', 'OLD', 't', faces['old'])
+    assert not gallery.legacy_employee_ids
+    reload()
+    assert not gallery.legacy_employee_ids
+
+
+def enroll_many(prefix, count, start):
+    start.wait()
+    for i in range(count):
+        employee_id = f"{prefix}{i}"
+        gallery.enroll_employee(employee_id, employee_id.upper(), 't', encoding_for(employee_id))
+        if i % 5 == 4:
+            gallery.delete_employee(f"{prefix}{i - 2}")
+
+
+@pytest.mark.skipif(gallery.fcntl is None or not hasattr(os, 'fork'),
+                    reason="needs fcntl file locks and fork")
+def test_two_processes_interleave_appends(monkeypatch):
+    # Small journal so the workers also compact under each other
+    monkeypatch.setattr(gallery, 'JOURNAL_COMPACT_BYTES', 8 * gallery.ENCODING_BYTES)
+    context = multiprocessing.get_context('fork')
+    start = context.Barrier(2)
+    workers = [context.Process(target=enroll_many, args=(prefix, 40, start)) for prefix in 'pq']
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+
+    expected = {f"{prefix}{i}" for prefix in 'pq' for i in range(40)}
+    expected -= {f"{prefix}{i - 2}" for prefix in 'pq' for i in range(4, 40, 5)}
+    loaded = reload()
+    assert set(loaded) == expected
+    for employee_id, (name, encoding) in loaded.items():
+        assert name == employee_id.upper()
+        np.testing.assert_array_equal(encoding, encoding_for(employee_id))